@@ -1,6 +1,6 @@
 # Main_app.py
+import os
 import streamlit as st
-import time
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 
@@ -9,36 +9,40 @@ load_dotenv() # Ensure this is at the very top
 # Core DB & agents imports (safe baseline)
 from db_models import (
     init_db,
-    create_user,
-    authenticate_user,
-    log_interaction,
-    add_mood,
-    get_mood_history,
-    SessionLocal,
-    Interaction,
-    User,
-    log_feedback
+    reset_request_cache,
+    create_user_with_verification,
+    authenticate_and_record,
+    unit_of_work,
+    get_user_by_username,
+    record_login,
+    record_login_success,
+    record_login_failure,
+    verify_email,
+    request_password_reset,
+    get_reset_token,
+    reset_password,
 )
+from security import verify_totp
 
 # --- THIS IS THE FIX ---
 # The old, incorrect 'mood_history_figure' has been removed from this import.
-from llm_tools import contains_crisis_keywords, send_email
+from llm_tools import send_email_background
 # --- END OF FIX ---
 
 # Config (with graceful fallbacks if new constants aren't present)
 try:
     from config import SECRET_KEY, VERIFY_LINK_TPL, RESET_LINK_TPL
 except Exception:
-    try:
-        from config import SECRET_KEY
-    except Exception:
-        SECRET_KEY = "dev-secret"
-    VERIFY_LINK_TPL = "http://localhost:8501?verify={token}"
-    RESET_LINK_TPL = "http://localhost:8501?reset={token}"
+    SECRET_KEY, VERIFY_LINK_TPL, RESET_LINK_TPL = (
+        "dev-secret", "http://localhost:8501?verify={token}", "http://localhost:8501?reset={token}"
+    )
+_verify_link = VERIFY_LINK_TPL.format
+_reset_link = RESET_LINK_TPL.format
 
 # ---------- Page Setup ----------
 st.set_page_config(page_title="Synermind — Multi-Agent Mental Wellness", layout="wide")
 init_db()
+reset_request_cache()  # user lookups are memoized for this script run only
 
 # ---------- Session State Defaults ----------
 if "user" not in st.session_state:
@@ -46,94 +50,63 @@ if "user" not in st.session_state:
 if "auth_mode" not in st.session_state:
     st.session_state.auth_mode = "Sign In"
 
+def _session_user(u):
+    """What the app keeps about the signed-in user; contacts are cached for the crisis path."""
+    return {
+        "id": u.id,
+        "username": u.username,
+        "email": u.email,
+        "emergency_contact": u.emergency_contact,
+    }
+
 # Helper: robust query param getter
-def _get_params():
-    try:
-        p = st.query_params
-        return dict(p)
-    except Exception:
-        p = st.experimental_get_query_params()
-        return {k: (v[0] if isinstance(v, list) and v else v) for k, v in p.items()}
+# Older Streamlit versions only ship experimental_get_query_params; probe once at import.
+_HAS_NEW_QP = hasattr(st, "query_params")
 
-params = _get_params()
+def _param(name):
+    if _HAS_NEW_QP:
+        return st.query_params.get(name)
+    p = st.experimental_get_query_params().get(name)
+    return p[0] if isinstance(p, list) and p else p
 
 # --- (The rest of your Main_app.py file is completely correct and remains unchanged) ---
 
 # ---------- Handle Query Params (email verification / reset) ----------
-if "verify" in params and params.get("verify"):
-    try:
-        from db_models import verify_email
-        if verify_email(params.get("verify")):
-            st.toast("Email verified successfully. You can sign in now.", icon="✅")
-            st.session_state.auth_mode = "Sign In"
-        else:
-            st.toast("Verification link is invalid or expired.", icon="⚠️")
-    except Exception:
-        st.toast("Verification link processing failed.", icon="⚠️")
+# Query params only matter on the auth landing page, and only need handling once per session.
+if st.session_state.user is None and not st.session_state.get("__params_handled"):
+    verify_token = _param("verify")
+    if verify_token:
+        try:
+            if verify_email(verify_token):
+                st.toast("Email verified successfully. You can sign in now.", icon="✅")
+                st.session_state.auth_mode = "Sign In"
+            else:
+                st.toast("Verification link is invalid or expired.", icon="⚠️")
+        except Exception:
+            st.toast("Verification link processing failed.", icon="⚠️")
+
+    reset_token = _param("reset")
+    if reset_token:
+        st.session_state["__show_reset_panel"] = True
+        st.session_state["__reset_token"] = reset_token
 
-if "reset" in params and params.get("reset"):
-    st.session_state["__show_reset_panel"] = True
-    st.session_state["__reset_token"] = params.get("reset")
+    st.session_state["__params_handled"] = True
 
 if "__post_signup_auth_mode" in st.session_state:
     st.session_state.auth_mode = st.session_state["__post_signup_auth_mode"]
     del st.session_state["__post_signup_auth_mode"]
 
 # ---------- Global Styles (modern calm theme) ----------
-st.markdown("""
-<style>
-@import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;600;700&family=Merriweather:wght@300;400;700&display=swap');
-:root{
-    --bg-1: #f4f9fb; /* very light blue */
-    --bg-2: rgba(255,255,255,0.65);
-    --accent: #6aa6d6; /* calm blue */
-    --muted: #6b7280;
-    --glass: rgba(255,255,255,0.55);
-    --agent-bg: rgba(240,248,255,0.75);
-    --user-bg: rgba(212,237,211,0.8);
-    --card-radius: 14px;
-}
-html, body, .stApp {
-    height: 100%;
-    background: linear-gradient(180deg, #eef7fb 0%, #f8fafc 60%);
-    font-family: 'Inter', system-ui, -apple-system, 'Segoe UI', Roboto, 'Helvetica Neue', Arial;
-    color: #0f172a;
-}
-
-/* Glass card for main content */
-.entry-wrap, .card {
-    background: linear-gradient(180deg, rgba(255,255,255,0.7), rgba(255,255,255,0.5));
-    backdrop-filter: blur(8px) saturate(120%);
-    border-radius: var(--card-radius);
-    border: 1px solid rgba(255,255,255,0.6);
-    box-shadow: 0 6px 30px rgba(16,24,40,0.08);
-}
-
-.app-title{ font-family: 'Merriweather', serif; font-size: 1.6rem; font-weight:700; color: #0b3a57 }
-
-/* Chat bubble styles */
-.chat-wrapper{ padding: 12px; }
-.chat-row{ margin-bottom: 10px; display:flex; align-items:flex-start; }
-.chat-bubble{ max-width:640px; padding:12px 16px; border-radius:12px; font-size:0.98rem; line-height:1.4; box-shadow: 0 4px 18px rgba(11,26,40,0.06);}
-.chat-bubble.agent{ background: linear-gradient(180deg, rgba(255,255,255,0.8), var(--agent-bg)); border-left:4px solid rgba(106,166,214,0.7); color:#07263a; border-top-left-radius:6px; border-bottom-left-radius:6px;}
-.chat-bubble.user{ background: linear-gradient(180deg, rgba(255,255,255,0.8), var(--user-bg)); border-right:4px solid rgba(29,155,88,0.7); color:#03310b; border-top-right-radius:6px; border-bottom-right-radius:6px;}
-
-/* Left / right column helpers */
-.left-col{ display:flex; justify-content:flex-start; }
-.right-col{ display:flex; justify-content:flex-end; }
+_CSS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "app.css")
 
-/* Minor UI touches */
-.stSidebar { background: linear-gradient(180deg, rgba(255,255,255,0.7), rgba(245,250,255,0.6)); }
-.section-title{ font-weight:600; color:var(--accent); }
+@st.cache_data(show_spinner=False)
+def _load_css() -> str:
+    with open(_CSS_PATH, encoding="utf-8") as f:
+        return f.read()
 
-/* Make code blocks and links gentler */
-pre, code{ background: rgba(15,23,42,0.03); padding:6px; border-radius:8px; }
-a{ color:var(--accent); }
-
-/* Responsive tweaks */
-@media (max-width: 800px){ .chat-bubble{ max-width: 90%; } }
-</style>
-""", unsafe_allow_html=True)
+# Streamlit removes elements that a rerun doesn't emit, so the style tag is sent every run;
+# only the file read is cached.
+st.markdown(f"<style>{_load_css()}</style>", unsafe_allow_html=True)
 
 # ---------- Auth Landing (centered) ----------
 def render_auth_landing():
@@ -173,31 +146,31 @@ def render_auth_landing():
             st.session_state["__show_forgot_panel"] = True
 
         if sign_in_submitted:
+            now_utc = datetime.now(timezone.utc)
             try:
-                from db_models import get_user_by_username, record_login_failure, record_login_success
-                db_user = get_user_by_username(si_username.strip())
-                if db_user and db_user.locked_until and db_user.locked_until > datetime.now(timezone.utc):
-                    st.error("Account temporarily locked due to multiple failed attempts. Try again later.")
-                else:
-                    user = authenticate_user(si_username.strip(), si_password)
-                    if user:
-                        if getattr(user, "mfa_enabled", False) and getattr(user, "mfa_secret", None):
-                            st.session_state["__mfa_user_id"] = user.id
-                            st.session_state["__mfa_username"] = user.username
-                            st.session_state["__pending_password_auth"] = True
-                            st.rerun()
-                        else:
-                            record_login_success(user.id)
-                            try:
-                                from db_models import record_login
-                                record_login(user.username)
-                            except Exception:
-                                pass
-                            st.session_state.user = {"id": user.id, "username": user.username}
-                            st.rerun()
+                # One session for the lookup, password check and login bookkeeping; it commits
+                # when the block exits, so st.rerun() (which bypasses `except Exception`) comes after.
+                rerun = False
+                with unit_of_work() as db:
+                    db_user = get_user_by_username(si_username.strip(), db=db)
+                    if db_user and db_user.locked_until and db_user.locked_until > now_utc:
+                        st.error("Account temporarily locked due to multiple failed attempts. Try again later.")
                     else:
-                        record_login_failure(si_username.strip())
-                        st.error("Invalid credentials. Please check your username or password.")
+                        # Records the login (unless MFA is still pending) in this same transaction.
+                        user = authenticate_and_record(si_username.strip(), si_password, db=db)
+                        if user:
+                            if getattr(user, "mfa_enabled", False) and getattr(user, "mfa_secret", None):
+                                st.session_state["__mfa_user_id"] = user.id
+                                st.session_state["__mfa_username"] = user.username
+                                st.session_state["__pending_password_auth"] = True
+                            else:
+                                st.session_state.user = _session_user(user)
+                            rerun = True
+                        else:
+                            record_login_failure(si_username.strip(), db=db)
+                            st.error("Invalid credentials. Please check your username or password.")
+                if rerun:
+                    st.rerun()
             except Exception as e:
                 st.error(f"Sign-in failed: {e}")
 
@@ -208,19 +181,16 @@ def render_auth_landing():
                 ok = st.form_submit_button("Verify")
             if ok:
                 try:
-                    from db_models import get_user_by_username, record_login_success
-                    from security import verify_totp
                     uid = st.session_state.get("__mfa_user_id")
                     uname = st.session_state.get("__mfa_username")
-                    u = get_user_by_username(uname)
-                    if u and verify_totp(u.mfa_secret, otp):
-                        record_login_success(u.id)
-                        try:
-                            from db_models import record_login
-                            record_login(u.username)
-                        except Exception:
-                            pass
-                        st.session_state.user = {"id": u.id, "username": u.username}
+                    with unit_of_work() as db:
+                        u = get_user_by_username(uname, db=db)
+                        verified = bool(u and verify_totp(u.mfa_secret, otp))
+                        if verified:
+                            record_login_success(u.id, db=db)
+                            record_login(u.id, db=db)
+                    if verified:
+                        st.session_state.user = _session_user(u)
                         for k in ["__pending_password_auth", "__mfa_user_id", "__mfa_username"]:
                             st.session_state.pop(k, None)
                         st.rerun()
@@ -236,13 +206,12 @@ def render_auth_landing():
                 send = st.form_submit_button("Send reset link")
             if send:
                 try:
-                    from db_models import request_password_reset, get_reset_token
                     if request_password_reset(fp_email.strip()):
                         token_exp = get_reset_token(fp_email.strip())
                         if token_exp:
                             token, exp = token_exp
-                            link = RESET_LINK_TPL.format(token=token)
-                            res = send_email(
+                            link = _reset_link(token=token)
+                            res = send_email_background(
                                 fp_email.strip(),
                                 "Reset your Synermind password",
                                 f"Click to reset your password:\n{link}\n\nThis link expires in 2 hours."
@@ -271,7 +240,6 @@ def render_auth_landing():
                     st.error("Passwords must match and be at least 8 characters.")
                 else:
                     try:
-                        from db_models import reset_password
                         token = st.session_state.get("__reset_token")
                         if token and reset_password(token, npw):
                             st.success("Password updated. You can sign in now.")
@@ -293,27 +261,21 @@ def render_auth_landing():
             sign_up_submitted = st.form_submit_button("Create Account")
 
         if sign_up_submitted:
+            now_utc = datetime.now(timezone.utc)
             if not su_username.strip() or not su_email.strip() or not su_password:
                 st.error("Username, Email, and Password are required.")
             elif not agree:
                 st.error("You need to accept the Terms and Privacy to continue.")
             else:
-                user = create_user(su_username.strip(), su_password, su_email.strip(), su_emergency.strip())
+                user, vtoken = create_user_with_verification(
+                    su_username.strip(), su_password, su_email.strip(), su_emergency.strip(),
+                    accepted_terms_at=now_utc,
+                )
                 if user:
                     try:
-                        from db_models import SessionLocal, User, set_verification_token
-                        db = SessionLocal()
-                        try:
-                            u = db.query(User).filter_by(id=user.id).first()
-                            u.accepted_terms_at = datetime.now(timezone.utc)
-                            db.commit()
-                        finally:
-                            db.close()
-
-                        vtoken = set_verification_token(user.id)
                         if vtoken:
-                            link = VERIFY_LINK_TPL.format(token=vtoken)
-                            res = send_email(
+                            link = _verify_link(token=vtoken)
+                            res = send_email_background(
                                 user.email,
                                 "Verify your Synermind email",
                                 f"Welcome to Synermind!\n\nPlease verify your email by clicking:\n{link}\n\nThank you."
@@ -1,25 +1,46 @@
 # agents.py
-from langchain.memory import ConversationBufferWindowMemory
+import functools
+import streamlit as st
+from langchain.memory import ConversationSummaryBufferMemory, ConversationTokenBufferMemory
 from langchain.agents import initialize_agent, AgentType
 from langchain.chains import ConversationChain
 from langchain.prompts import PromptTemplate
 
-from llm_tools import get_llm_provider, GET_MOOD_HISTORY_TOOL, SEND_ALERT_TOOL
+from config import DEBUG
+from llm_tools import get_llm_provider, GET_MOOD_HISTORY_TOOL, SEND_ALERT_TOOL, ALERT_QUEUED
 
-def get_agents():
+def _approx_token_ids(text: str):
     """
-    Initializes the final, stable, hybrid system of agents.
-    Mood and Therapy are stable ConversationChains for dialogue.
-    Routine and Crisis are stable ZERO_SHOT agents for tool use.
+    Approximates tokens as ~4 characters, the same estimate main_ui uses to trim context.
+    Lets token-bounded memories size themselves without a tokenizer dependency.
     """
-    llm_conversational = get_llm_provider(
-        provider="groq",
-        model_name="llama-3.1-8b-instant",
-        temperature=0.75
-    )
+    return [0] * (len(text) // 4 + 1)
 
-    # --- Conversational Chain: Mood (Stable, tool-free) ---
-    _MOOD_PROMPT_TEMPLATE = """You are 'Mindful', a warm, non-judgmental, and empathetic companion. Your only job is to have a natural and supportive conversation.
+# One client per (provider, model, temperature) for the whole process, so the provider's
+# HTTP connection pool survives even if the get_agents() cache is cleared.
+@functools.lru_cache(maxsize=8)
+def _cached_llm(provider: str, model_name: str, temperature: float):
+    llm = get_llm_provider(provider=provider, model_name=model_name, temperature=temperature)
+    if hasattr(llm, "custom_get_token_ids"):
+        llm = llm.model_copy(update={"custom_get_token_ids": _approx_token_ids})
+    return llm
+
+_CONVERSATIONAL_LLM = ("groq", "llama-3.1-8b-instant", 0.75)
+
+# Memory is per-user state, so it is never part of the cached agents below.
+# Each agent gets a fresh memory from these factories per session (see bind_session_memory).
+# Mood/Therapy summarize older turns; tool-using agents keep a verbatim, token-capped buffer
+# because ReAct traces don't summarize well.
+_MEMORY_FACTORIES = {
+    "mood": lambda llm: ConversationSummaryBufferMemory(llm=llm, max_token_limit=800, memory_key="history"),
+    "therapy": lambda llm: ConversationSummaryBufferMemory(llm=llm, max_token_limit=800, memory_key="history"),
+    "routine": lambda llm: ConversationTokenBufferMemory(llm=llm, max_token_limit=600, memory_key="chat_history"),
+    "crisis": lambda llm: ConversationTokenBufferMemory(llm=llm, max_token_limit=400, memory_key="chat_history"),
+}
+
+# --- Prompts (built once at import; shared by every get_agents() build) ---
+# The indented continuation lines are part of the prompt text sent to the model; keep them.
+_MOOD_PROMPT_TEMPLATE = """You are 'Mindful', a warm, non-judgmental, and empathetic companion. Your only job is to have a natural and supportive conversation.
     **Your Conversational Rules:**
     1. Validate the user's feelings with a short, sincere sentence.
     2. Always end your response with a single, open-ended follow-up question in *italics* to encourage the user to share more.
@@ -28,15 +49,9 @@ def get_agents():
     {history}
     Human: {input}
     AI:"""
-    MOOD_PROMPT = PromptTemplate(input_variables=["history", "input"], template=_MOOD_PROMPT_TEMPLATE)
-    mood_agent = ConversationChain(
-        llm=llm_conversational,
-        memory=ConversationBufferWindowMemory(k=10, memory_key="history"),
-        prompt=MOOD_PROMPT
-    )
+MOOD_PROMPT = PromptTemplate(input_variables=["history", "input"], template=_MOOD_PROMPT_TEMPLATE)
 
-    # --- Conversational Chain: Therapy (Stable, tool-free) ---
-    _THERAPY_PROMPT_TEMPLATE = """You are a compassionate and insightful CBT-based guide. Your persona is a wise and patient mentor.
+_THERAPY_PROMPT_TEMPLATE = """You are a compassionate and insightful CBT-based guide. Your persona is a wise and patient mentor.
     **Your Conversational Rules:**
     1. Help the user explore their thoughts by asking powerful, open-ended questions. Do not give direct advice.
     2. Always end your response with a guiding question formatted in *italics*.
@@ -45,15 +60,9 @@ def get_agents():
     {history}
     Human: {input}
     AI:"""
-    THERAPY_PROMPT = PromptTemplate(input_variables=["history", "input"], template=_THERAPY_PROMPT_TEMPLATE)
-    therapy_agent = ConversationChain(
-        llm=llm_conversational,
-        memory=ConversationBufferWindowMemory(k=10, memory_key="history"),
-        prompt=THERAPY_PROMPT
-    )
+THERAPY_PROMPT = PromptTemplate(input_variables=["history", "input"], template=_THERAPY_PROMPT_TEMPLATE)
 
-    # --- ReAct Agent: Routine (THE FINAL FIX: A strict, procedural prompt) ---
-    ROUTINE_AGENT_PREFIX = """You are a supportive and logical Wellness Coach. Your primary job is to provide routine suggestions using the user's most recent input by default.
+ROUTINE_AGENT_PREFIX = """You are a supportive and logical Wellness Coach. Your primary job is to provide routine suggestions using the user's most recent input by default.
     **Behavior Rules (priority order):**
     1. If the user asks for a routine using their recent input (for example: "I need a morning routine to help with focus today"), use that recent input to generate suggestions immediately. DO NOT call any tools.
     2. Only if the user explicitly requests suggestions "based on my mood history" or similar phrasing, you MUST call the `get_mood_history` tool as your FIRST action. The tool's `Action Input` should be the username (not numeric id) provided by the user/session.
@@ -75,36 +84,83 @@ def get_agents():
         Final Answer: (Personalized routine referencing mood history) *Would you like to try this or adjust it?*
 
     You have access to the following tools:"""
+
+CRISIS_AGENT_SYSTEM_MESSAGE = (
+    "You are a Crisis Response Agent. Your ONLY job is to protect user safety.\n"
+    "Your FIRST and ONLY action MUST be to use the `send_alert` tool IMMEDIATELY, before any other thought or response.\n"
+    "Do NOT ask questions, do NOT wait, do NOT respond to the user until the alert is sent.\n"
+    "The tool's Action Input MUST be a multi-line string: [User ID]\\n[Subject]\\n[Message].\n"
+    "For [Subject], use: CRISIS ALERT: User expresses intent for self-harm.\n"
+    "For [Message], copy the user's exact message.\n"
+    "After the alert is sent, provide a calm, supportive message with a real-world resource (e.g., the 988 hotline).\n"
+    "If you do anything else first, you are failing your mission."
+)
+
+# Used by run_crisis_turn once the alert email is queued, so the LLM only writes the reply.
+CRISIS_SUPPORT_PROMPT = PromptTemplate.from_template(
+    "You are a Crisis Response Agent. An alert has already been sent to the user's emergency contact.\n"
+    "Reply to the user with a short, calm, supportive message. Do not ask them to wait. "
+    "Include a real-world resource (e.g., the 988 hotline).\n\n"
+    "User message: {user_msg}"
+)
+
+CRISIS_FALLBACK_REPLY = (
+    "It sounds like you are in distress. An alert has been dispatched to your emergency contact. "
+    "Please reach out to a trusted person or a crisis hotline (such as 988) immediately."
+)
+
+CRISIS_UNSENT_REPLY = (
+    "It sounds like you are in distress. Please reach out to a trusted person "
+    "or a crisis hotline (such as 988) immediately."
+)
+
+@st.cache_resource(show_spinner=False)
+def get_agents():
+    """
+    Initializes the final, stable, hybrid system of agents.
+    Mood and Therapy are stable ConversationChains for dialogue.
+    Routine and Crisis are stable ZERO_SHOT agents for tool use.
+    Built once per process and shared across sessions; use bind_session_memory()
+    to get an agent wired to the current user's memory.
+    """
+    llm_conversational = _cached_llm(*_CONVERSATIONAL_LLM)
+
+    # --- Conversational Chain: Mood (Stable, tool-free) ---
+    mood_agent = ConversationChain(
+        llm=llm_conversational,
+        memory=_MEMORY_FACTORIES["mood"](llm_conversational),
+        prompt=MOOD_PROMPT
+    )
+
+    # --- Conversational Chain: Therapy (Stable, tool-free) ---
+    therapy_agent = ConversationChain(
+        llm=llm_conversational,
+        memory=_MEMORY_FACTORIES["therapy"](llm_conversational),
+        prompt=THERAPY_PROMPT
+    )
+
+    # --- ReAct Agent: Routine (THE FINAL FIX: A strict, procedural prompt) ---
     routine_agent = initialize_agent(
         tools=[GET_MOOD_HISTORY_TOOL],
         llm=llm_conversational,
         agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
-        memory=ConversationBufferWindowMemory(k=6, memory_key="chat_history"),
-        verbose=True, # Keep verbose on for testing this agent
+        memory=_MEMORY_FACTORIES["routine"](llm_conversational),
+        verbose=DEBUG,
         handle_parsing_errors=True,
         agent_kwargs={"prefix": ROUTINE_AGENT_PREFIX}
     )
 
 
     # --- Conversational ReAct Agent: Crisis (Forceful Immediate Tool Use) ---
-    CRISIS_AGENT_SYSTEM_MESSAGE = (
-        "You are a Crisis Response Agent. Your ONLY job is to protect user safety.\n"
-        "Your FIRST and ONLY action MUST be to use the `send_alert` tool IMMEDIATELY, before any other thought or response.\n"
-        "Do NOT ask questions, do NOT wait, do NOT respond to the user until the alert is sent.\n"
-        "The tool's Action Input MUST be a multi-line string: [User ID]\\n[Subject]\\n[Message].\n"
-        "For [Subject], use: CRISIS ALERT: User expresses intent for self-harm.\n"
-        "For [Message], copy the user's exact message.\n"
-        "After the alert is sent, provide a calm, supportive message with a real-world resource (e.g., the 988 hotline).\n"
-        "If you do anything else first, you are failing your mission."
-    )
     crisis_agent = initialize_agent(
         tools=[SEND_ALERT_TOOL],
         llm=llm_conversational,
         agent=AgentType.CONVERSATIONAL_REACT_DESCRIPTION,
-        memory=ConversationBufferWindowMemory(k=8, memory_key="chat_history"),
+        memory=_MEMORY_FACTORIES["crisis"](llm_conversational),
         verbose=False,
         handle_parsing_errors=True,
-        max_iterations=10,
+        max_iterations=2,
+        early_stopping_method="generate",
         agent_kwargs={"system_message": CRISIS_AGENT_SYSTEM_MESSAGE}
     )
 
@@ -113,4 +169,73 @@ def get_agents():
         "therapy": therapy_agent,
         "routine": routine_agent,
         "crisis": crisis_agent,
-    }
\ No newline at end of file
+    }
+
+def get_session_memory(agent_name: str, user_id: int):
+    """Returns this session's memory for an agent, creating it on first use."""
+    memories = st.session_state.setdefault("__agent_memory", {})
+    key = (user_id, agent_name)
+    if key not in memories:
+        memories[key] = _MEMORY_FACTORIES[agent_name](_cached_llm(*_CONVERSATIONAL_LLM))
+    return memories[key]
+
+def bind_session_memory(agent_name: str, agent, user_id: int):
+    """
+    Returns a shallow copy of a cached agent that uses the current user's memory.
+    The LLM, prompt and tools stay shared; only the memory differs per session,
+    so concurrent sessions never write into each other's history.
+    """
+    return agent.model_copy(update={"memory": get_session_memory(agent_name, user_id)})
+
+def run_crisis_turn(user_id: int, user_msg: str) -> str:
+    """
+    Handles a crisis turn without the ReAct loop: the crisis agent's first action is always
+    send_alert, so call the tool directly and use the LLM only for the supportive reply.
+    Only a queued email counts as an alert; otherwise the user is not told help is on the way
+    and the failure is stored in crisis_error for the page to show.
+    """
+    try:
+        alert_result = SEND_ALERT_TOOL.run(f"{user_id}\nCRISIS ALERT: User expresses intent for self-harm.\n{user_msg}")
+    except Exception as e:
+        alert_result = f"ERROR sending alert: {e}"
+    if not alert_result.startswith(ALERT_QUEUED):
+        print(f"Crisis alert not sent: {alert_result}")
+        st.session_state['crisis_error'] = f"Crisis alert could not be sent. Reason: {alert_result}"
+        return CRISIS_UNSENT_REPLY
+
+    try:
+        reply = _cached_llm(*_CONVERSATIONAL_LLM).invoke(CRISIS_SUPPORT_PROMPT.format(user_msg=user_msg))
+        return getattr(reply, "content", None) or CRISIS_FALLBACK_REPLY
+    except Exception as e:
+        # The alert is already out; never retry (and re-alert) just because the reply failed.
+        print(f"Crisis support reply failed: {e}")
+        return CRISIS_FALLBACK_REPLY
+
+# Agents whose replies can be streamed token-by-token (plain prompt -> LLM, no tool loop).
+STREAMING_AGENTS = {"mood", "therapy"}
+
+def stream_conversation(agent, text: str):
+    """
+    Streams a ConversationChain's reply chunk by chunk. ConversationChain.stream() only
+    yields the finished output, so this formats the chain's own prompt with its memory,
+    streams straight from its LLM, and records the turn in memory once complete.
+    """
+    inputs = agent.prep_inputs({"input": text})
+    chunks = []
+    for chunk in agent.llm.stream(agent.prompt.format(**inputs)):
+        piece = getattr(chunk, "content", chunk)
+        if piece:
+            chunks.append(piece)
+            yield piece
+    agent.memory.save_context({"input": text}, {agent.output_key: "".join(chunks)})
+
+def stream_agent(agent, text: str):
+    """
+    Streams a tool-using AgentExecutor's reply via AgentExecutor.stream(). Intermediate chunks
+    carry actions/steps; only the final chunk has "output", so this yields it as soon as the
+    tool loop finishes. Memory is saved by the executor itself.
+    """
+    for chunk in agent.stream({"input": text}):
+        output = chunk.get("output")
+        if output:
+            yield output
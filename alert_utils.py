@@ -1,9 +1,58 @@
+import atexit
 import smtplib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from typing import List
 
+# One authenticated SMTP connection per (server, port, sender), reused across alerts
+# so each send doesn't pay for a fresh TCP connect + STARTTLS + AUTH.
+_POOL = {}
+_LOCK = threading.Lock()
+
+# Alerts are delivered from a worker thread so callers (e.g. the crisis agent) don't block on SMTP.
+_MAIL_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="synermind-smtp")
+
+def _connect(smtp_server: str, smtp_port: int, sender_email: str, sender_password: str):
+    conn = smtplib.SMTP(smtp_server, smtp_port)
+    conn.starttls()
+    conn.login(sender_email, sender_password)
+    return conn
+
+def _get_conn(smtp_server: str, smtp_port: int, sender_email: str, sender_password: str):
+    """Returns a live pooled connection, reconnecting if the server dropped it."""
+    key = (smtp_server, smtp_port, sender_email)
+    conn = _POOL.get(key)
+    if conn is not None:
+        try:
+            conn.noop()
+            return conn
+        except Exception:
+            _POOL.pop(key, None)
+    conn = _connect(smtp_server, smtp_port, sender_email, sender_password)
+    _POOL[key] = conn
+    return conn
+
+@atexit.register
+def _close_pool():
+    with _LOCK:
+        for conn in _POOL.values():
+            try:
+                conn.quit()
+            except Exception:
+                pass
+        _POOL.clear()
+
 def send_alert(subject: str, body: str, recipients: List[str], smtp_server: str, smtp_port: int, sender_email: str, sender_password: str):
+    """
+    Queue an alert email (or SMS via email-to-SMS gateway) and return immediately.
+    Takes the same arguments as _send_alert_now and returns the Future of its result
+    ({"ok": True} or {"ok": False, "error": ...}); call .result() to wait for delivery.
+    """
+    return _MAIL_POOL.submit(_send_alert_now, subject, body, recipients, smtp_server, smtp_port, sender_email, sender_password)
+
+def _send_alert_now(subject: str, body: str, recipients: List[str], smtp_server: str, smtp_port: int, sender_email: str, sender_password: str):
     """
     Send an alert email (or SMS via email-to-SMS gateway) to the specified recipients.
     :param subject: Email subject
@@ -21,10 +70,18 @@ def send_alert(subject: str, body: str, recipients: List[str], smtp_server: str,
     msg.attach(MIMEText(body, 'plain'))
 
     try:
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(sender_email, sender_password)
-            server.sendmail(sender_email, recipients, msg.as_string())
+        # smtplib connections are not thread-safe, so sends on the pool are serialized.
+        with _LOCK:
+            server = _get_conn(smtp_server, smtp_port, sender_email, sender_password)
+            try:
+                server.sendmail(sender_email, recipients, msg.as_string())
+            except smtplib.SMTPServerDisconnected:
+                # The server closed the connection between noop() and sendmail(); retry once.
+                _POOL.pop((smtp_server, smtp_port, sender_email), None)
+                server = _get_conn(smtp_server, smtp_port, sender_email, sender_password)
+                server.sendmail(sender_email, recipients, msg.as_string())
         print(f"Alert sent to: {recipients}")
+        return {"ok": True}
     except Exception as e:
         print(f"Failed to send alert: {e}")
+        return {"ok": False, "error": str(e)}
@@ -1,25 +1,129 @@
 # db_models.py
 from sqlalchemy import (
-    create_engine, Column, Integer, String, DateTime, Text, Boolean, ForeignKey
+    create_engine, event, func, inspect, select, insert, update, case,
+    Column, Integer, String, DateTime, Text, Boolean, ForeignKey, Index,
 )
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship
-from sqlalchemy.sql import func
 from sqlalchemy.exc import IntegrityError
-from datetime import datetime, timedelta, timezone
-from sqlalchemy import func, distinct
-from datetime import date, timedelta
-from config import DATABASE_URL
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import contextvars
+import functools
+from config import DATABASE_URL, SECRET_KEY, BCRYPT_ROUNDS
 import bcrypt
+import hashlib
+import hmac
+import os
 import secrets
+import threading
+
+# Day boundaries for login metrics are IST; resolved once at import.
+_IST = ZoneInfo("Asia/Kolkata")
+_UTC = timezone.utc
 
 # ---------- SQLAlchemy setup ----------
 Base = declarative_base()
-engine = create_engine(DATABASE_URL, echo=False, future=True)
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+# Larger pool than the 5/10 default so concurrent Streamlit sessions don't queue on checkout;
+# pre_ping replaces dead connections instead of failing the request.
+# (In-memory SQLite uses a single-connection pool that doesn't take these options.)
+_POOL_KWARGS = {} if ":memory:" in DATABASE_URL else dict(
+    pool_size=10, max_overflow=20, pool_timeout=30, pool_pre_ping=True
+)
+engine = create_engine(DATABASE_URL, echo=False, future=True, **_POOL_KWARGS)
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_conn, _record):
+        """
+        WAL lets readers run alongside the writer and turns each commit into a log append;
+        synchronous=NORMAL only fsyncs at checkpoints, which is still crash-safe under WAL.
+        """
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.execute("PRAGMA mmap_size=268435456")  # 256 MB
+        cur.execute("PRAGMA cache_size=-65536")    # 64 MB
+        cur.close()
+# expire_on_commit=False so objects returned by the helpers stay readable after their session closes.
+SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, expire_on_commit=False)
+
+@contextmanager
+def unit_of_work():
+    """
+    One session inside one explicit transaction (Session.begin): commits once on success,
+    rolls back on error, then closes. Entry points open it once and pass it as `db=`
+    to the helpers, which then don't commit themselves.
+    """
+    with SessionLocal.begin() as s:
+        yield s
+
+@contextmanager
+def session_scope(db=None):
+    """
+    Yields `db` when the caller already has a session, so several helpers can share one
+    connection and transaction; the caller then owns commit/rollback/close.
+    Otherwise runs the body in its own unit_of_work().
+    """
+    if db is not None:
+        yield db
+        return
+    with unit_of_work() as s:
+        yield s
+
+# ---------- Per-request user lookup cache ----------
+# One script run = one request. Main_app calls reset_request_cache() at the top of each run;
+# helpers that write to `users` drop the cache so later lookups in the run see fresh rows.
+_REQ_USER_CACHE = contextvars.ContextVar("req_user_cache", default=None)
+
+def reset_request_cache():
+    _REQ_USER_CACHE.set({})
+
+def _invalidate_user_cache():
+    cache = _REQ_USER_CACHE.get()
+    if cache:
+        cache.clear()
+
+def request_cached(fn):
+    """Memoizes successful lookups of `fn(key)` for the rest of the current request."""
+    @functools.wraps(fn)
+    def wrapper(key, db=None):
+        cache = _REQ_USER_CACHE.get()
+        if cache is None:
+            cache = {}
+            _REQ_USER_CACHE.set(cache)
+        ck = (fn.__name__, key.strip() if isinstance(key, str) else key)
+        if ck in cache:
+            return cache[ck]
+        val = fn(key, db=db)
+        if val is not None:
+            cache[ck] = val
+        return val
+    return wrapper
 
 # ---------- Password Utilities ----------
+# bcrypt releases the GIL, so a hash started on this pool runs while the caller does other work.
+_HASH_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 2, thread_name_prefix="synermind-hash")
+
+# Checked against when a username doesn't exist, so failed logins take the same time
+# whether or not the account is real.
+_DUMMY_HASH = bcrypt.hashpw(b"synermind-dummy", bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
+
 def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode()
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
+
+def hash_password_async(password: str):
+    """Returns a Future resolving to hash_password(password)."""
+    return _HASH_POOL.submit(hash_password, password)
+
+def _needs_rehash(hashed: str) -> bool:
+    # bcrypt hashes look like $2b$<cost>$<salt+hash>
+    try:
+        return int(hashed.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError, AttributeError):
+        return False
 
 def verify_password(password: str, hashed: str) -> bool:
     try:
@@ -33,11 +137,26 @@ def _now():
 def _new_token(n=24):
     return secrets.token_urlsafe(n)
 
+def _token_digest(token: str) -> str:
+    """
+    Keyed SHA-256 of a verification/reset token, stored alongside it as the lookup key.
+    Queries match on the digest, so SQL never compares the secret token itself.
+    """
+    return hmac.new(SECRET_KEY.encode("utf-8"), token.encode("utf-8"), hashlib.sha256).hexdigest()
+
+def _tokens_match(stored: str, supplied: str) -> bool:
+    # Always run the comparison, even with nothing stored, so a miss costs the same as a hit.
+    same = hmac.compare_digest((stored or "").encode("utf-8"), supplied.encode("utf-8"))
+    return bool(stored) and same
+
 # ---------- Models ----------
+# Models returned from write helpers set eager_defaults, so server-generated id/created_at
+# come back on the INSERT itself (RETURNING) and no refresh() SELECT is needed.
 class User(Base):
     __tablename__ = "users"
+    __mapper_args__ = {"eager_defaults": True}
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     username = Column(String(128), unique=True, index=True, nullable=False)
     password_hash = Column(String(256), nullable=False)
     email = Column(String(256), nullable=False)
@@ -46,9 +165,11 @@ class User(Base):
 
     # Security/compliance fields
     email_verified = Column(Boolean, default=False)
-    verification_token = Column(String(64), index=True, nullable=True)
+    verification_token = Column(String(64), nullable=True)
+    verification_token_hmac = Column(String(64), index=True, nullable=True)
 
-    reset_token = Column(String(64), index=True, nullable=True)
+    reset_token = Column(String(64), nullable=True)
+    reset_token_hmac = Column(String(64), index=True, nullable=True)
     reset_token_expires = Column(DateTime(timezone=True), nullable=True)
 
     mfa_enabled = Column(Boolean, default=False)
@@ -68,7 +189,9 @@ class User(Base):
 
 class MoodLog(Base):
     __tablename__ = "mood_logs"
-    id = Column(Integer, primary_key=True, index=True)
+    __table_args__ = (Index("ix_mood_logs_user_created", "user_id", "created_at"),)
+    __mapper_args__ = {"eager_defaults": True}
+    id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     mood = Column(String(64))
     intensity = Column(Integer, default=5)
@@ -80,7 +203,9 @@ class MoodLog(Base):
 
 class Interaction(Base):
     __tablename__ = "interactions"
-    id = Column(Integer, primary_key=True, index=True)
+    __table_args__ = (Index("ix_interactions_user_created", "user_id", "created_at"),)
+    __mapper_args__ = {"eager_defaults": True}
+    id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     agent_type = Column(String(64))
     user_msg = Column(Text)
@@ -92,7 +217,8 @@ class Interaction(Base):
 
 class Alert(Base):
     __tablename__ = "alerts"
-    id = Column(Integer, primary_key=True, index=True)
+    __mapper_args__ = {"eager_defaults": True}
+    id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     alert_type = Column(String(100))
     message = Column(Text)
@@ -103,7 +229,8 @@ class Alert(Base):
 
 class Feedback(Base):
     __tablename__ = "feedback"
-    id = Column(Integer, primary_key=True, index=True)
+    __mapper_args__ = {"eager_defaults": True}
+    id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     rating = Column(Integer, nullable=False)
     comment = Column(Text, nullable=True)
@@ -111,41 +238,36 @@ class Feedback(Base):
 
     user = relationship("User", backref="feedback_entries")
 
-# Add after Feedback model
-import pytz
-
 class LoginEvent(Base):
     __tablename__ = "login_events"
-    id = Column(Integer, primary_key=True, index=True)
+    __table_args__ = (Index("ix_login_events_user_created", "user_id", "created_at"),)
+    id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     user = relationship("User", backref="login_events")
 
-def record_login(user_identifier):
+def record_login(user_identifier, db=None):
     """
     Record a login event for the given username or id.
     Returns dict: {'ok': True, 'daily_logins': <int>, 'login_event_id': <int>}
     """
-    db = SessionLocal()
-    try:
+    with session_scope(db) as s:
         # Use your existing resolve_user_identifier
-        uid = resolve_user_identifier(user_identifier)
-        ev = LoginEvent(user_id=uid)
-        db.add(ev)
-        db.commit()
-        db.refresh(ev)
+        uid = resolve_user_identifier(user_identifier, db=s)
+        ev_id = s.execute(
+            insert(LoginEvent).values(user_id=uid).returning(LoginEvent.id)
+        ).scalar_one()
 
         # Compute daily login count using IST day boundary
-        ist = pytz.timezone("Asia/Kolkata")
-        now_ist = datetime.now(ist)
+        now_ist = datetime.now(_IST)
         start_ist = now_ist.replace(hour=0, minute=0, second=0, microsecond=0)
         end_ist = start_ist + timedelta(days=1)
         # Convert to UTC to compare with DB timestamps stored in UTC
-        start_utc = start_ist.astimezone(pytz.utc)
-        end_utc = end_ist.astimezone(pytz.utc)
+        start_utc = start_ist.astimezone(_UTC)
+        end_utc = end_ist.astimezone(_UTC)
 
         daily_count = (
-            db.query(LoginEvent)
+            s.query(LoginEvent)
             .filter(
                 LoginEvent.user_id == uid,
                 LoginEvent.created_at >= start_utc,
@@ -154,105 +276,190 @@ def record_login(user_identifier):
             .count()
         )
 
-        return {"ok": True, "daily_logins": daily_count, "login_event_id": ev.id}
-    except Exception:
-        db.rollback()
-        raise
-    finally:
-        db.close()
+        return {"ok": True, "daily_logins": daily_count, "login_event_id": ev_id}
 
-def log_feedback(user_id: int, rating: int, comment: str):
-    db = SessionLocal()
-    try:
+_BULK_CHUNK = 500
+
+def record_logins_bulk(events, db=None):
+    """
+    Insert many login events in one transaction (e.g. importing historical logins).
+    `events` is an iterable of (user_id, created_at) pairs; a None timestamp means now.
+    Rows go through executemany in chunks of _BULK_CHUNK. Returns the number inserted.
+    """
+    rows = [{"user_id": uid, "created_at": ts or _now()} for uid, ts in events]
+    with session_scope(db) as s:
+        for i in range(0, len(rows), _BULK_CHUNK):
+            s.execute(LoginEvent.__table__.insert(), rows[i:i + _BULK_CHUNK])
+    return len(rows)
+
+def log_feedback(user_id: int, rating: int, comment: str, db=None):
+    with session_scope(db) as s:
         fb = Feedback(user_id=user_id, rating=rating, comment=comment)
-        db.add(fb)
-        db.commit()
-        db.refresh(fb)
+        s.add(fb)
+        s.flush()
         return fb
-    finally:
-        db.close()
+
+_DB_READY = False
+_DB_INIT_LOCK = threading.Lock()
 
 def init_db():
-    """Create tables if they do not exist."""
-    Base.metadata.create_all(bind=engine)
+    """
+    Create tables if they do not exist, then add any columns older DBs are missing.
+    Runs once per process: Main_app calls it on every Streamlit rerun, and the migration
+    takes SQLite's write lock.
+    """
+    global _DB_READY
+    if _DB_READY:
+        return
+    with _DB_INIT_LOCK:
+        if _DB_READY:
+            return
+        Base.metadata.create_all(bind=engine)
+        if engine.dialect.name == "sqlite":
+            ensure_user_columns()
+        _DB_READY = True
 
 # ---------- One-time additive migration for existing DB ----------
+# (column name, DDL) for every `users` column added after the table first shipped.
+_USER_COLUMN_MIGRATIONS = (
+    ("email_verified", "ALTER TABLE users ADD COLUMN email_verified BOOLEAN DEFAULT 0;"),
+    ("verification_token", "ALTER TABLE users ADD COLUMN verification_token VARCHAR(64);"),
+    ("reset_token", "ALTER TABLE users ADD COLUMN reset_token VARCHAR(64);"),
+    ("reset_token_expires", "ALTER TABLE users ADD COLUMN reset_token_expires DATETIME;"),
+    ("mfa_enabled", "ALTER TABLE users ADD COLUMN mfa_enabled BOOLEAN DEFAULT 0;"),
+    ("mfa_secret", "ALTER TABLE users ADD COLUMN mfa_secret VARCHAR(64);"),
+    ("accepted_terms_at", "ALTER TABLE users ADD COLUMN accepted_terms_at DATETIME;"),
+    ("failed_logins", "ALTER TABLE users ADD COLUMN failed_logins INTEGER DEFAULT 0;"),
+    ("locked_until", "ALTER TABLE users ADD COLUMN locked_until DATETIME;"),
+    ("last_login_at", "ALTER TABLE users ADD COLUMN last_login_at DATETIME;"),
+    ("verification_token_hmac", "ALTER TABLE users ADD COLUMN verification_token_hmac VARCHAR(64);"),
+    ("reset_token_hmac", "ALTER TABLE users ADD COLUMN reset_token_hmac VARCHAR(64);"),
+)
+
+# Indexes older versions created that are now redundant: INTEGER PRIMARY KEY is already
+# the rowid B-tree, and tokens are looked up through their *_hmac columns.
+_DROPPED_INDEXES = (
+    "ix_users_id", "ix_mood_logs_id", "ix_interactions_id", "ix_alerts_id",
+    "ix_feedback_id", "ix_login_events_id",
+    "ix_users_verification_token", "ix_users_reset_token",
+)
+
+# Indexes that create_all() won't add to tables that already exist.
+_INDEX_MIGRATIONS = (
+    "CREATE INDEX IF NOT EXISTS ix_users_verification_token_hmac ON users (verification_token_hmac);",
+    "CREATE INDEX IF NOT EXISTS ix_users_reset_token_hmac ON users (reset_token_hmac);",
+    "CREATE INDEX IF NOT EXISTS ix_mood_logs_user_created ON mood_logs (user_id, created_at);",
+    "CREATE INDEX IF NOT EXISTS ix_interactions_user_created ON interactions (user_id, created_at);",
+    "CREATE INDEX IF NOT EXISTS ix_login_events_user_created ON login_events (user_id, created_at);",
+)
+
 def ensure_user_columns():
     """
     One-time additive migration for existing SQLite DBs.
-    Adds new columns to `users` table if they don't exist.
-    Safe to call on every startup.
+    Adds new columns to `users` table and missing indexes if they don't exist.
+    Safe to call on every startup: one schema read, then all DDL in a single transaction.
     """
-    conn = engine.connect()
-    try:
-        # Get existing column names
-        res = conn.exec_driver_sql("PRAGMA table_info(users);").fetchall()
-        cols = {row[1] for row in res}  # row[1] = column name
-
-        def add(col_sql: str):
-            conn.exec_driver_sql(col_sql)
-
-        # Add columns if missing (SQLite supports ADD COLUMN)
-        if "email_verified" not in cols:
-            add("ALTER TABLE users ADD COLUMN email_verified BOOLEAN DEFAULT 0;")
-        if "verification_token" not in cols:
-            add("ALTER TABLE users ADD COLUMN verification_token VARCHAR(64);")
-        if "reset_token" not in cols:
-            add("ALTER TABLE users ADD COLUMN reset_token VARCHAR(64);")
-        if "reset_token_expires" not in cols:
-            add("ALTER TABLE users ADD COLUMN reset_token_expires DATETIME;")
-        if "mfa_enabled" not in cols:
-            add("ALTER TABLE users ADD COLUMN mfa_enabled BOOLEAN DEFAULT 0;")
-        if "mfa_secret" not in cols:
-            add("ALTER TABLE users ADD COLUMN mfa_secret VARCHAR(64);")
-        if "accepted_terms_at" not in cols:
-            add("ALTER TABLE users ADD COLUMN accepted_terms_at DATETIME;")
-        if "failed_logins" not in cols:
-            add("ALTER TABLE users ADD COLUMN failed_logins INTEGER DEFAULT 0;")
-        if "locked_until" not in cols:
-            add("ALTER TABLE users ADD COLUMN locked_until DATETIME;")
-        if "last_login_at" not in cols:
-            add("ALTER TABLE users ADD COLUMN last_login_at DATETIME;")
-    finally:
-        conn.close()
+    cols = {c["name"] for c in inspect(engine).get_columns("users")}
+    with engine.begin() as conn:
+        for name, ddl in _USER_COLUMN_MIGRATIONS:
+            if name not in cols:
+                conn.exec_driver_sql(ddl)
+        for name in _DROPPED_INDEXES:
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {name};")
+        for ddl in _INDEX_MIGRATIONS:
+            conn.exec_driver_sql(ddl)
+
+        # Backfill lookup digests for tokens issued before the digest columns existed
+        pending = conn.exec_driver_sql(
+            "SELECT id, verification_token, reset_token FROM users "
+            "WHERE (verification_token IS NOT NULL AND verification_token_hmac IS NULL) "
+            "OR (reset_token IS NOT NULL AND reset_token_hmac IS NULL);"
+        ).fetchall()
+        for uid, vtoken, rtoken in pending:
+            conn.exec_driver_sql(
+                "UPDATE users SET verification_token_hmac = ?, reset_token_hmac = ? WHERE id = ?;",
+                (_token_digest(vtoken) if vtoken else None, _token_digest(rtoken) if rtoken else None, uid),
+            )
 
 # ---------- CRUD & Auth ----------
-def create_user(username: str, password: str, email: str, emergency_contact: str):
-    db = SessionLocal()
+def _new_user(s, username: str, pw_hash, email: str, emergency_contact: str,
+              accepted_terms_at=None, with_verification: bool = False):
+    """
+    Adds and flushes a new User in session `s`; optionally with an email verification token.
+    `pw_hash` is the Future from hash_password_async(), started by the caller before the
+    session was opened: the username check below runs while bcrypt is still hashing, and a
+    taken username returns None without waiting for the hash.
+    """
+    username = username.strip()
+    if s.execute(select(User.id).where(User.username == username).limit(1)).first() is not None:
+        pw_hash.cancel()
+        return None
+    user = User(
+        username=username,
+        password_hash=pw_hash.result(),
+        email=email.strip(),
+        emergency_contact=emergency_contact.strip() if emergency_contact else None,
+        accepted_terms_at=accepted_terms_at,
+    )
+    if with_verification:
+        user.verification_token = _new_token()
+        user.verification_token_hmac = _token_digest(user.verification_token)
+    s.add(user)
+    s.flush()
+    return user
+
+# Every helper takes an optional `db` session; see session_scope().
+def create_user(username: str, password: str, email: str, emergency_contact: str, accepted_terms_at=None, db=None):
+    """
+    Returns the new User, or None if the username is taken. A username that loses the
+    insert race (IntegrityError) also returns None when this call owns the session; with a
+    caller's `db` the error is re-raised, since that transaction now has to be rolled back.
+    """
+    _invalidate_user_cache()
+    pw_hash = hash_password_async(password)
     try:
-        user = User(
-            username=username.strip(),
-            password_hash=hash_password(password),
-            email=email.strip(),
-            emergency_contact=emergency_contact.strip() if emergency_contact else None,
-        )
-        db.add(user)
-        db.commit()
-        db.refresh(user)
-        return user
+        with session_scope(db) as s:
+            return _new_user(s, username, pw_hash, email, emergency_contact, accepted_terms_at)
     except IntegrityError:
-        db.rollback()
+        if db is not None:
+            raise
         return None
-    finally:
-        db.close()
 
-def get_user_by_username(username: str):
-    db = SessionLocal()
+def create_user_with_verification(username: str, password: str, email: str, emergency_contact: str, accepted_terms_at=None, db=None):
+    """
+    Creates a user with terms acceptance and an email verification token in one INSERT.
+    Returns (user, verification_token), or (None, None) if the username is taken.
+    IntegrityError is re-raised when `db` is the caller's session, as in create_user().
+    """
+    _invalidate_user_cache()
+    pw_hash = hash_password_async(password)
     try:
-        return db.query(User).filter(User.username == username.strip()).first()
-    finally:
-        db.close()
+        with session_scope(db) as s:
+            user = _new_user(
+                s, username, pw_hash, email, emergency_contact, accepted_terms_at, with_verification=True
+            )
+            return (user, user.verification_token) if user else (None, None)
+    except IntegrityError:
+        if db is not None:
+            raise
+        return None, None
 
+@request_cached
+def get_user_by_username(username: str, db=None):
+    with session_scope(db) as s:
+        return s.query(User).filter(User.username == username.strip()).first()
 
-def get_user_id_by_username(username: str):
+
+@request_cached
+def get_user_id_by_username(username: str, db=None):
     """
     Returns the integer user id for a username, or None if not found.
     """
-    u = get_user_by_username(username)
+    u = get_user_by_username(username, db=db)
     return u.id if u else None
 
 
-def resolve_user_identifier(user_identifier):
+def resolve_user_identifier(user_identifier, db=None):
     """
     Accepts either an integer user id or a username string. Returns an integer user id
     or raises ValueError if the user cannot be resolved.
@@ -269,249 +476,340 @@ def resolve_user_identifier(user_identifier):
 
     # Otherwise try to resolve as username
     if isinstance(user_identifier, str):
-        uid = get_user_id_by_username(user_identifier.strip())
+        uid = get_user_id_by_username(user_identifier.strip(), db=db)
         if uid:
             return uid
 
     raise ValueError(f"Could not resolve user identifier: {user_identifier}")
 
-def authenticate_user(username: str, password: str):
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter(User.username == username.strip()).first()
-        if not user:
+def authenticate_user(username: str, password: str, db=None):
+    with session_scope(db) as s:
+        user = s.query(User).filter(User.username == username.strip()).first()
+        ok = verify_password(password, user.password_hash if user else _DUMMY_HASH)
+        if not (user and ok):
             return None
-        if verify_password(password, user.password_hash):
-            return user
-        return None
-    finally:
-        db.close()
+        # Lazy upgrade: re-hash at the configured cost while we have the plaintext.
+        if _needs_rehash(user.password_hash):
+            user.password_hash = hash_password(password)
+        return user
 
-def record_login_success(user_id: int):
-    db = SessionLocal()
-    try:
-        u = db.query(User).filter(User.id == user_id).first()
-        if u:
-            u.failed_logins = 0
-            u.locked_until = None
-            u.last_login_at = _now()
-            db.commit()
-    finally:
-        db.close()
-
-def record_login_failure(username: str, max_attempts=5, lock_minutes=15):
-    db = SessionLocal()
-    try:
-        u = db.query(User).filter(User.username == username.strip()).first()
-        if u:
-            u.failed_logins += 1
-            if u.failed_logins >= max_attempts:
-                u.locked_until = _now() + timedelta(minutes=lock_minutes)
-            db.commit()
-    finally:
-        db.close()
+def authenticate_and_record(username: str, password: str, db=None):
+    """
+    authenticate_user() plus the login-success bookkeeping (reset lockout counters,
+    last_login_at, LoginEvent row) committed in one transaction.
+    Users with MFA enabled are returned without recording; the caller records the
+    login once the second factor checks out.
+    """
+    with session_scope(db) as s:
+        user = authenticate_user(username, password, db=s)
+        if user and not (user.mfa_enabled and user.mfa_secret):
+            record_login_success(user.id, db=s)
+            s.add(LoginEvent(user_id=user.id))
+        return user
 
-# ---------- Email verification & password reset ----------
-def set_verification_token(user_id: int):
-    db = SessionLocal()
-    try:
-        u = db.query(User).filter(User.id == user_id).first()
-        if not u:
-            return None
-        u.verification_token = _new_token()
-        db.commit()
-        db.refresh(u)
-        return u.verification_token
-    finally:
-        db.close()
-
-def verify_email(token: str) -> bool:
-    db = SessionLocal()
-    try:
-        u = db.query(User).filter(User.verification_token == token).first()
-        if not u:
-            return False
-        u.email_verified = True
-        u.verification_token = None
-        db.commit()
-        return True
-    finally:
-        db.close()
+def record_login_success(user_id: int, db=None):
+    _invalidate_user_cache()
+    with session_scope(db) as s:
+        s.execute(
+            update(User)
+            .where(User.id == user_id)
+            .values(failed_logins=0, locked_until=None, last_login_at=_now())
+        )
 
-def request_password_reset(email: str) -> bool:
-    db = SessionLocal()
-    try:
-        u = db.query(User).filter(User.email == email.strip()).first()
-        if not u:
+def record_login_failure(username: str, max_attempts=5, lock_minutes=15, db=None):
+    _invalidate_user_cache()
+    # Single UPDATE; the right-hand side sees the pre-update failed_logins.
+    attempts = func.coalesce(User.failed_logins, 0) + 1
+    with session_scope(db) as s:
+        s.execute(
+            update(User)
+            .where(User.username == username.strip())
+            .values(
+                failed_logins=attempts,
+                locked_until=case(
+                    (attempts >= max_attempts, _now() + timedelta(minutes=lock_minutes)),
+                    else_=User.locked_until,
+                ),
+            )
+        )
+
+# ---------- Email verification & password reset ----------
+def set_verification_token(user_id: int, db=None):
+    _invalidate_user_cache()
+    token = _new_token()
+    with session_scope(db) as s:
+        res = s.execute(
+            update(User)
+            .where(User.id == user_id)
+            .values(verification_token=token, verification_token_hmac=_token_digest(token))
+        )
+        return token if res.rowcount else None
+
+def verify_email(token: str, db=None) -> bool:
+    _invalidate_user_cache()
+    with session_scope(db) as s:
+        row = s.execute(
+            select(User.id, User.verification_token)
+            .where(User.verification_token_hmac == _token_digest(token))
+        ).first()
+        ok = _tokens_match(row.verification_token if row else None, token)
+        if not (row and ok):
             return False
-        u.reset_token = _new_token()
-        u.reset_token_expires = _now() + timedelta(hours=2)
-        db.commit()
+        s.execute(
+            update(User)
+            .where(User.id == row.id)
+            .values(email_verified=True, verification_token=None, verification_token_hmac=None)
+        )
         return True
-    finally:
-        db.close()
 
-def get_reset_token(email: str):
-    db = SessionLocal()
-    try:
-        u = db.query(User).filter(User.email == email.strip()).first()
-        if not u or not u.reset_token:
+def request_password_reset(email: str, db=None) -> bool:
+    _invalidate_user_cache()
+    token = _new_token()
+    with session_scope(db) as s:
+        res = s.execute(
+            update(User)
+            .where(User.email == email.strip())
+            .values(
+                reset_token=token,
+                reset_token_hmac=_token_digest(token),
+                reset_token_expires=_now() + timedelta(hours=2),
+            )
+        )
+        return res.rowcount > 0
+
+def get_reset_token(email: str, db=None):
+    with session_scope(db) as s:
+        row = s.execute(
+            select(User.reset_token, User.reset_token_expires).where(User.email == email.strip())
+        ).first()
+        if not row or not row.reset_token:
             return None
-        return u.reset_token, u.reset_token_expires
-    finally:
-        db.close()
-
-def reset_password(token: str, new_password: str) -> bool:
-    db = SessionLocal()
-    try:
-        u = db.query(User).filter(User.reset_token == token).first()
-        if not u or not u.reset_token_expires or u.reset_token_expires < _now():
+        return row.reset_token, row.reset_token_expires
+
+def reset_password(token: str, new_password: str, db=None) -> bool:
+    _invalidate_user_cache()
+    with session_scope(db) as s:
+        row = s.execute(
+            select(User.id, User.reset_token, User.reset_token_expires)
+            .where(User.reset_token_hmac == _token_digest(token))
+        ).first()
+        ok = _tokens_match(row.reset_token if row else None, token)
+        if not (row and ok):
             return False
-        u.password_hash = hash_password(new_password)
-        u.reset_token = None
-        u.reset_token_expires = None
-        db.commit()
+        if not row.reset_token_expires or row.reset_token_expires < _now():
+            return False
+        s.execute(
+            update(User)
+            .where(User.id == row.id)
+            .values(
+                password_hash=hash_password(new_password),
+                reset_token=None,
+                reset_token_hmac=None,
+                reset_token_expires=None,
+            )
+        )
         return True
-    finally:
-        db.close()
 
 # ---------- MFA ----------
-def set_mfa(user_id: int, enabled: bool, secret: str = None):
-    db = SessionLocal()
-    try:
-        u = db.query(User).filter(User.id == user_id).first()
-        if not u:
-            return False
-        u.mfa_enabled = enabled
-        u.mfa_secret = secret
-        db.commit()
-        return True
-    finally:
-        db.close()
+def set_mfa(user_id: int, enabled: bool, secret: str = None, db=None):
+    _invalidate_user_cache()
+    with session_scope(db) as s:
+        res = s.execute(
+            update(User).where(User.id == user_id).values(mfa_enabled=enabled, mfa_secret=secret)
+        )
+        return res.rowcount > 0
 
 # ---------- App data helpers ----------
-def log_interaction(user_id: int, agent_type: str, user_msg: str, agent_reply: str):
-    db = SessionLocal()
-    try:
+def log_interaction(user_id: int, agent_type: str, user_msg: str, agent_reply: str, db=None):
+    with session_scope(db) as s:
         inter = Interaction(
             user_id=user_id, agent_type=agent_type, user_msg=user_msg, agent_reply=agent_reply
         )
-        db.add(inter)
-        db.commit()
-        db.refresh(inter)
+        s.add(inter)
+        s.flush()
         return inter
-    finally:
-        db.close()
+
+def log_turn(user_id: int, agent_type: str, user_msg: str, agent_reply: str,
+             mood: str = None, intensity: int = 5, db=None):
+    """
+    Writes one chat turn: the interaction and, when a mood was extracted from the message,
+    its mood log, in a single transaction (one commit instead of two).
+    Returns (interaction, mood_log or None).
+    """
+    with session_scope(db) as s:
+        inter = Interaction(
+            user_id=user_id, agent_type=agent_type, user_msg=user_msg, agent_reply=agent_reply
+        )
+        ml = MoodLog(user_id=user_id, mood=mood, intensity=intensity) if mood else None
+        s.add_all([inter, ml] if ml is not None else [inter])
+        s.flush()
+        return inter, ml
+
+def get_chat_history_version(user_id: int, db=None):
+    """
+    (count, max id) of the user's chat interactions in one aggregate query; changes whenever
+    a message is logged or history is cleared, so it can key a cached history load.
+    """
+    with session_scope(db) as s:
+        count, last_id = s.execute(
+            select(func.count(), func.max(Interaction.id))
+            .where(Interaction.user_id == user_id, Interaction.agent_type != "feedback")
+        ).one()
+        return count, last_id or 0
+
+def log_interactions_bulk(interactions, db=None):
+    """
+    Insert many interactions in one transaction (analytics backfills).
+    `interactions` is an iterable of dicts with user_id, agent_type, user_msg, agent_reply
+    and optionally created_at. Returns the number inserted.
+    """
+    rows = [
+        {
+            "user_id": r["user_id"],
+            "agent_type": r["agent_type"],
+            "user_msg": r["user_msg"],
+            "agent_reply": r["agent_reply"],
+            "created_at": r.get("created_at") or _now(),
+        }
+        for r in interactions
+    ]
+    with session_scope(db) as s:
+        for i in range(0, len(rows), _BULK_CHUNK):
+            s.execute(Interaction.__table__.insert(), rows[i:i + _BULK_CHUNK])
+    return len(rows)
 
 
-def add_mood(user_id: int, mood: str, intensity: int = 5, note: str = None):
-    db = SessionLocal()
-    try:
+def add_mood(user_id: int, mood: str, intensity: int = 5, note: str = None, db=None):
+    with session_scope(db) as s:
         ml = MoodLog(user_id=user_id, mood=mood, intensity=intensity, note=note)
-        db.add(ml)
-        db.commit()
-        db.refresh(ml)
+        s.add(ml)
+        s.flush()
         return ml
-    finally:
-        db.close()
 
-def get_mood_history(user_id: int):
-    db = SessionLocal()
-    try:
-        rows = (
-            db.query(MoodLog)
-            .filter(MoodLog.user_id == user_id)
+def count_mood_logs(user_id: int, db=None) -> int:
+    with session_scope(db) as s:
+        return s.execute(
+            select(func.count()).select_from(MoodLog).where(MoodLog.user_id == user_id)
+        ).scalar()
+
+def iter_mood_history(user_id: int, db=None, batch_size: int = 500):
+    """
+    Yields (created_at, mood, intensity) rows oldest-first, fetched in batches of
+    `batch_size` so long histories are never fully materialized. Holds a session until exhausted.
+    """
+    with session_scope(db) as s:
+        stmt = (
+            select(MoodLog.created_at, MoodLog.mood, MoodLog.intensity)
+            .where(MoodLog.user_id == user_id)
             .order_by(MoodLog.created_at.asc())
-            .all()
+            .execution_options(yield_per=batch_size)
         )
-        return rows
-    finally:
-        db.close()
+        for row in s.execute(stmt):
+            yield row
 
-def create_alert(user_id: int, alert_type: str, message: str):
-    db = SessionLocal()
-    try:
+def get_mood_history(user_id: int, db=None):
+    """List form of iter_mood_history(); rows expose .created_at, .mood and .intensity."""
+    return list(iter_mood_history(user_id, db=db))
+
+def create_alert(user_id: int, alert_type: str, message: str, db=None):
+    with session_scope(db) as s:
         a = Alert(user_id=user_id, alert_type=alert_type, message=message)
-        db.add(a)
-        db.commit()
-        db.refresh(a)
+        s.add(a)
+        s.flush()
         return a
-    finally:
-        db.close()
 
-def delete_user_interactions(user_id: int):
+def delete_user_interactions(user_id: int, db=None):
     """Deletes all interactions for a given user, excluding feedback."""
-    db = SessionLocal()
     try:
-        # This deletes all rows in the 'interactions' table that match the user_id
-        # and are not feedback entries.
-        db.query(Interaction).filter(
-            Interaction.user_id == user_id,
-            Interaction.agent_type != "feedback"
-        ).delete(synchronize_session=False)
-        db.commit()
+        with session_scope(db) as s:
+            # This deletes all rows in the 'interactions' table that match the user_id
+            # and are not feedback entries.
+            s.query(Interaction).filter(
+                Interaction.user_id == user_id,
+                Interaction.agent_type != "feedback"
+            ).delete(synchronize_session=False)
         return True
     except Exception as e:
         print(f"Error deleting interactions for user {user_id}: {e}")
-        db.rollback()
         return False
-    finally:
-        db.close()
 
-def get_user_metrics(user_id: int) -> dict:
+def _logins_per_ist_day(s, user_id: int) -> dict:
+    """
+    {IST date: login count} for a user. Timestamps are stored in UTC. On SQLite the
+    database buckets them (date() with a "+05:30" modifier, so one row per login day comes
+    back); that modifier is SQLite-only, so other backends bucket the rows in Python.
+    """
+    if engine.dialect.name == "sqlite":
+        ist_day = func.date(LoginEvent.created_at, "+05:30").label("d")
+        day_rows = (
+            s.query(ist_day, func.count().label("n"))
+            .filter(LoginEvent.user_id == user_id)
+            .group_by(ist_day)
+            .all()
+        )
+        return {date.fromisoformat(d): n for d, n in day_rows if d}
+
+    counts = {}
+    for ts in s.execute(
+        select(LoginEvent.created_at).where(LoginEvent.user_id == user_id)
+    ).scalars():
+        if ts is None:
+            continue
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=_UTC)
+        d = ts.astimezone(_IST).date()
+        counts[d] = counts.get(d, 0) + 1
+    return counts
+
+def get_user_metrics(user_id: int, db=None) -> dict:
     """
     Aggregates and calculates key metrics for a specific user.
     Now returns 'daily_logins' and 'conversation_streak' (consecutive-day streak based on login events, IST).
     """
-    db = SessionLocal()
-    try:
-        # 1. Interaction Metrics (unchanged)
-        interactions = db.query(Interaction).filter(Interaction.user_id == user_id).all()
-        total_interactions = len(interactions)
+    with session_scope(db) as s:
+        # 1. Scalar totals in one statement (one scalar subquery per table, so no join fan-out)
+        totals = s.execute(
+            select(
+                select(func.count()).select_from(Interaction)
+                .where(Interaction.user_id == user_id).scalar_subquery().label("interactions"),
+                select(func.avg(Feedback.rating))
+                .where(Feedback.user_id == user_id).scalar_subquery().label("avg_feedback"),
+                select(func.count()).select_from(MoodLog)
+                .where(MoodLog.user_id == user_id).scalar_subquery().label("moods"),
+            )
+        ).one()
+        total_interactions = totals.interactions
+        avg_feedback = totals.avg_feedback or 0
+        total_moods_logged = totals.moods
+
+        # Agent usage (needs its own GROUP BY)
 
-        agent_usage = db.query(Interaction.agent_type, func.count(Interaction.agent_type)).\
+        agent_usage = s.query(Interaction.agent_type, func.count(Interaction.agent_type)).\
             filter(Interaction.user_id == user_id, Interaction.agent_type != 'feedback').\
             group_by(Interaction.agent_type).all()
         agent_usage_dict = {agent: count for agent, count in agent_usage}
 
         # 2. Login-based metrics (daily_logins and consecutive-day streak)
         try:
-            login_rows = db.query(LoginEvent.created_at).filter(LoginEvent.user_id == user_id).all()
-            ist = pytz.timezone("Asia/Kolkata")
-            today_ist = datetime.now(ist).date()
+            today_ist = datetime.now(_IST).date()
+            logins_per_day = _logins_per_ist_day(s, user_id)
 
             # Count ALL login events for today (not just unique dates)
-            daily_logins = 0
-            login_dates_set = set()
-            for (ts,) in login_rows:
-                if ts is None:
-                    continue
-                if ts.tzinfo is None:
-                    ts = ts.replace(tzinfo=timezone.utc)
-                dt_ist = ts.astimezone(ist)
-                if dt_ist.date() == today_ist:
-                    daily_logins += 1
-                login_dates_set.add(dt_ist.date())
+            daily_logins = logins_per_day.get(today_ist, 0)
 
             # conversation_streak: consecutive-day streak (based on unique login dates)
-            login_dates = sorted(list(login_dates_set), reverse=True)
+            # Walk back one day at a time with O(1) dict lookups; no sort needed.
             streak = 0
-            if login_dates:
-                current = today_ist if today_ist in login_dates else login_dates[0]
-                while current in login_dates:
+            if logins_per_day:
+                current = today_ist if today_ist in logins_per_day else max(logins_per_day)
+                while current in logins_per_day:
                     streak += 1
                     current = current - timedelta(days=1)
-        except Exception:
-            login_rows = []
+        except Exception as e:
+            print(f"Login metrics failed for user {user_id}: {e}")
             daily_logins = 0
             streak = 0
 
-        # 3. Feedback Metrics (unchanged)
-        avg_feedback = db.query(func.avg(Feedback.rating)).filter(Feedback.user_id == user_id).scalar() or 0
-
-        # 4. Mood Log Metrics
-        total_moods_logged = db.query(MoodLog).filter(MoodLog.user_id == user_id).count()
-
         return {
             "total_interactions": total_interactions,
             "agent_usage": agent_usage_dict,
@@ -520,8 +818,6 @@ def get_user_metrics(user_id: int) -> dict:
             "avg_feedback_rating": round(avg_feedback, 2),
             "total_moods_logged": total_moods_logged,
         }
-    finally:
-        db.close()
 
 if __name__ == "__main__":
     init_db()
@@ -1,10 +1,24 @@
 # llm_tools.py
 import os
 import re
+import asyncio
+import functools
+from datetime import timezone
+import atexit
 import logging
-import pandas as pd
-import plotly.express as px
-from typing import Dict, Any
+import math
+import queue
+import threading
+import traceback
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import Future, ThreadPoolExecutor
+import httpx
+from typing import TYPE_CHECKING, Dict, Any, List, Iterable, Tuple
+
+# numpy, pandas and plotly are only needed by the Mood Insights page and the mood-history
+# tool, so they are imported inside those functions rather than on every app start.
+if TYPE_CHECKING:
+    import pandas as pd
 
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_groq import ChatGroq
@@ -13,10 +27,32 @@ from langchain.prompts import PromptTemplate
 from langchain.chains import LLMChain
 
 from config import GEMINI_API_KEY, GROQ_API_KEY, SENDGRID_API_KEY, SENDGRID_FROM_EMAIL
-
+from db_models import (
+    User,
+    add_mood,
+    count_mood_logs,
+    create_alert,
+    get_mood_history,
+    iter_mood_history,
+    resolve_user_identifier,
+    unit_of_work,
+)
+
+try:
+    from sendgrid import SendGridAPIClient
+    from sendgrid.helpers.mail import Mail, Personalization, To
+except ImportError:
+    SendGridAPIClient = Mail = Personalization = To = None
+
+# One SendGrid client for the process instead of one per email.
+_SG_CLIENT = SendGridAPIClient(SENDGRID_API_KEY) if (SendGridAPIClient and SENDGRID_API_KEY) else None
+
+@functools.lru_cache(maxsize=16)
 def get_llm_provider(provider: str = "groq", model_name: str = "llama-3.1-8b-instant", temperature: float = 0.3):
     """
     Returns a LangChain-compatible LLM from a specific provider.
+    Memoized per (provider, model_name, temperature) so the client and its HTTP
+    connection pool are reused.
     """
     if provider == "groq":
         api_key = GROQ_API_KEY
@@ -44,23 +80,65 @@ def get_llm_provider(provider: str = "groq", model_name: str = "llama-3.1-8b-ins
     class DummyLLM:
         def invoke(self, *args, **kwargs):
             return AIMessage(content="(No LLM configured — set GEMINI_API_KEY and/or GROQ_API_KEY.)")
+        async def ainvoke(self, *args, **kwargs):
+            return self.invoke(*args, **kwargs)
     return DummyLLM()
 
+# One long-lived event loop for async LLM calls. The cached clients above keep async
+# connection pools that are bound to the loop they were first used on, so every call
+# goes through this loop instead of a throwaway asyncio.run() loop.
+_ASYNC_LOOP = None
+_ASYNC_LOOP_LOCK = threading.Lock()
+
+def run_async(coro):
+    """Runs `coro` on the shared background event loop and blocks until it finishes."""
+    global _ASYNC_LOOP
+    with _ASYNC_LOOP_LOCK:
+        if _ASYNC_LOOP is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="synermind-async", daemon=True).start()
+            _ASYNC_LOOP = loop
+    return asyncio.run_coroutine_threadsafe(coro, _ASYNC_LOOP).result()
+
+_MOOD_EXTRACTOR_PROMPT = PromptTemplate.from_template(
+    "Analyze the user's message. Identify the primary mood being expressed. "
+    "Respond with a single word from this list: [happy, sad, anxious, angry, content, stressed, neutral]. "
+    "If no clear mood is stated, respond with the single word 'None'. "
+    "Do not add any other words or punctuation.\n\n"
+    "User message: {input}"
+)
+_MOOD_CHAIN = None
+
 def get_mood_extractor_chain():
     """
-    Creates a simple, fast, and reliable chain whose ONLY job is to extract a mood.
+    Returns the process-wide chain whose ONLY job is to extract a mood (built on first use).
     It uses Gemini for higher accuracy in this critical classification task.
     """
-    llm_classifier = get_llm_provider(provider="gemini", model_name="gemini-2.5-flash", temperature=0.0)
-    
-    extractor_prompt = PromptTemplate.from_template(
-        "Analyze the user's message. Identify the primary mood being expressed. "
-        "Respond with a single word from this list: [happy, sad, anxious, angry, content, stressed, neutral]. "
-        "If no clear mood is stated, respond with the single word 'None'. "
-        "Do not add any other words or punctuation.\n\n"
-        "User message: {input}"
-    )
-    return LLMChain(llm=llm_classifier, prompt=extractor_prompt, verbose=False)
+    global _MOOD_CHAIN
+    if _MOOD_CHAIN is None:
+        llm_classifier = get_llm_provider(provider="gemini", model_name="gemini-2.5-flash", temperature=0.0)
+        _MOOD_CHAIN = LLMChain(llm=llm_classifier, prompt=_MOOD_EXTRACTOR_PROMPT, verbose=False)
+    return _MOOD_CHAIN
+
+def extract_moods_bulk(messages: List[str], max_concurrency: int = 16) -> List[str]:
+    """
+    Classifies many messages at once (e.g. re-analysing a user's history) using the
+    chain's batch API, so requests run concurrently instead of one round trip each.
+    Returns one lowercase mood word per message, in order.
+    """
+    if not messages:
+        return []
+    chain = get_mood_extractor_chain()
+    results = chain.batch([{"input": m} for m in messages], config={"max_concurrency": max_concurrency})
+    return [r["text"].strip().lower() for r in results]
+
+async def aextract_moods_bulk(messages: List[str], max_concurrency: int = 16) -> List[str]:
+    """Async counterpart of extract_moods_bulk."""
+    if not messages:
+        return []
+    chain = get_mood_extractor_chain()
+    results = await chain.abatch([{"input": m} for m in messages], config={"max_concurrency": max_concurrency})
+    return [r["text"].strip().lower() for r in results]
 
 
 CRISIS_KEYWORDS = [
@@ -68,12 +146,67 @@ CRISIS_KEYWORDS = [
     "hurt myself", "want to die", "i'm going to die"
 ]
 
+# Default matcher: plain substring search on the lowered text. For a handful of short
+# keywords CPython's two-way/memchr-backed str.find beats an IGNORECASE regex alternation
+# (which re-tries every alternative at each position) by roughly an order of magnitude.
+# Substring semantics are deliberate (e.g. "self-harming" still matches "self-harm").
+_CRISIS_KWS = tuple(kw.lower() for kw in CRISIS_KEYWORDS)
+
+# Hyperscan (SIMD multi-pattern DFA) when installed; else an Aho-Corasick automaton when
+# pyahocorasick is installed; otherwise the substring scan above. Both are optional.
+try:
+    import hyperscan
+    _CRISIS_HS = hyperscan.Database()
+    _CRISIS_HS.compile(
+        expressions=[re.escape(kw).encode("utf-8") for kw in CRISIS_KEYWORDS],
+        ids=list(range(len(CRISIS_KEYWORDS))),
+        elements=len(CRISIS_KEYWORDS),
+        flags=[hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SINGLEMATCH] * len(CRISIS_KEYWORDS),
+    )
+    _HS_LOCAL = threading.local()  # scratch space can't be shared between threads
+except ImportError:
+    _CRISIS_HS = None
+
+try:
+    import ahocorasick
+    _CRISIS_AC = ahocorasick.Automaton()
+    for _kw in CRISIS_KEYWORDS:
+        _CRISIS_AC.add_word(_kw, _kw)
+    _CRISIS_AC.make_automaton()
+except ImportError:
+    _CRISIS_AC = None
+
+def _hs_contains(text: str) -> bool:
+    scratch = getattr(_HS_LOCAL, "scratch", None)
+    if scratch is None:
+        scratch = _HS_LOCAL.scratch = hyperscan.Scratch(_CRISIS_HS)
+    hit = []
+    def _on_match(_id, _start, _end, _flags, _ctx):
+        hit.append(_id)
+        return True  # stop at the first match
+    try:
+        _CRISIS_HS.scan(text.encode("utf-8"), match_event_handler=_on_match, scratch=scratch)
+    except hyperscan.ScanTerminated:
+        pass
+    return bool(hit)
+
+# Nothing shorter than the shortest keyword can contain one.
+_MIN_CRISIS_KW_LEN = min(map(len, CRISIS_KEYWORDS))
+
 def contains_crisis_keywords(text: str) -> bool:
+    if not text or len(text) < _MIN_CRISIS_KW_LEN:
+        return False
+    if _CRISIS_HS is not None:
+        return _hs_contains(text)
+    if _CRISIS_AC is not None:
+        # The automaton is case-sensitive, so this path needs a folded copy of the text
+        return next(_CRISIS_AC.iter(text.casefold()), None) is not None
     t = text.lower()
-    return any(kw in t for kw in CRISIS_KEYWORDS)
+    return any(kw in t for kw in _CRISIS_KWS)
 
 
-# Setup a simple file logger for email operations
+# Setup a simple file logger for email operations. Callers only enqueue records;
+# a QueueListener thread does the file writes so request threads never block on disk.
 logger = logging.getLogger("synermind.email")
 if not logger.handlers:
     logger.setLevel(logging.DEBUG)
@@ -81,7 +214,11 @@ if not logger.handlers:
     fh.setLevel(logging.DEBUG)
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     fh.setFormatter(formatter)
-    logger.addHandler(fh)
+    _log_queue = queue.Queue(-1)
+    logger.addHandler(QueueHandler(_log_queue))
+    _log_listener = QueueListener(_log_queue, fh, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)  # flush queued records on shutdown
 
 
 # --- THIS SECTION IS THE FIX ---
@@ -92,52 +229,131 @@ def get_mood_insights_data(user_id):
     Timestamps are converted to IST (Asia/Kolkata) and date/time columns are provided.
     Accepts username or numeric id (resolve_user_identifier).
     """
-    from db_models import get_mood_history, resolve_user_identifier  # local import
-    import pytz
+    import numpy as np
+    import pandas as pd
+
     try:
         uid = resolve_user_identifier(user_id)
     except Exception:
         return None
 
-    rows = get_mood_history(uid)
-    if not rows:
+    # Stream rows straight into preallocated column arrays (sized by COUNT(*)) instead of
+    # materializing a list of rows first. Count and scan share one transaction/snapshot.
+    with unit_of_work() as db:
+        n = count_mood_logs(uid, db=db)
+        if not n:
+            return None
+        ts = np.empty(n, dtype="datetime64[ns]")
+        moods = np.empty(n, dtype=object)
+        intens = np.empty(n, dtype=np.float64)  # NaN marks a missing intensity
+        i = 0
+        for created_at, mood, intensity in iter_mood_history(uid, db=db, batch_size=1000):
+            if i == n:
+                break
+            if created_at is None:
+                ts[i] = np.datetime64("NaT")
+            else:
+                if created_at.tzinfo is not None:  # normalize to naive UTC
+                    created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+                ts[i] = np.datetime64(created_at, "ns")
+            moods[i] = mood.capitalize() if mood else None
+            intens[i] = np.nan if intensity is None else intensity
+            i += 1
+    if i == 0:
         return None
 
-    df = pd.DataFrame([
-        {"timestamp": r.created_at, "mood": (r.mood.capitalize() if r.mood else None), "intensity": r.intensity}
-        for r in rows
-    ])
-    if df.empty:
-        return None
+    # Compact mood enum; intensity as a nullable int (missing values survive). Int64 because
+    # rows logged before the 1-10 clamp in tool_log_mood may hold arbitrary integers.
+    df = pd.DataFrame({
+        "timestamp": ts[:i],
+        "mood": pd.Categorical(moods[:i]),
+        "intensity": pd.Series(intens[:i]).astype("Int64"),
+    })
 
-    # Ensure timestamp is datetime, localize naive as UTC, convert to IST
-    ist = pytz.timezone("Asia/Kolkata")
-    df["timestamp"] = pd.to_datetime(df["timestamp"], errors='coerce')
-    def _to_ist(ts):
-        if pd.isna(ts):
-            return pd.NaT
-        # if tz-naive assume UTC
-        if ts.tzinfo is None:
-            ts = ts.tz_localize("UTC")
-        return ts.tz_convert(ist)
-    df["timestamp_ist"] = df["timestamp"].apply(_to_ist)
+    # Treat stored timestamps as UTC and convert to IST in one vectorized pass (NaT stays NaT)
+    df["timestamp"] = pd.to_datetime(df["timestamp"], errors='coerce', utc=True)
+    df["timestamp_ist"] = df["timestamp"].dt.tz_convert("Asia/Kolkata")
 
     # date and time columns for display
     df["date"] = df["timestamp_ist"].dt.date
     df["time"] = df["timestamp_ist"].dt.strftime("%I:%M %p")  # 12-hour format
+    # int64 ns sort key: the 12-hour "time" strings don't sort chronologically
+    df["_dt"] = ts[:i].view("int64")
 
     return df
 
-def plot_mood_trend_graph(df: pd.DataFrame):
+def _daily_sums_counts_np(codes, intens, n_days):
+    """Per-day (sum, count) of intensity; code -1 (no date) and NaN intensities are skipped."""
+    import numpy as np
+
+    keep = (codes >= 0) & ~np.isnan(intens)
+    sums = np.bincount(codes[keep], weights=intens[keep], minlength=n_days)
+    counts = np.bincount(codes[keep], minlength=n_days)
+    return sums, counts
+
+def _daily_sums_counts_loop(codes, intens, sums, counts):
+    """The same reduction as one pass, filling sums/counts in place; compiled with numba."""
+    for i in range(codes.shape[0]):
+        c = codes[i]
+        v = intens[i]
+        if c >= 0 and not math.isnan(v):
+            sums[c] += v
+            counts[c] += 1
+
+@functools.lru_cache(maxsize=None)
+def _daily_sums_counts_impl():
+    """
+    Picks the per-day reduction on first use, so numba (optional, and by far the heaviest
+    import here) only loads when a trend chart is drawn. With numba the reduction runs as
+    one compiled pass with no temporary mask arrays; cache=True keeps the compiled kernel
+    on disk across restarts.
+    """
+    try:
+        from numba import njit
+    except ImportError:
+        return _daily_sums_counts_np
+    kernel = njit(cache=True)(_daily_sums_counts_loop)
+
+    def daily_sums_counts(codes, intens, n_days):
+        import numpy as np
+
+        sums = np.zeros(n_days, dtype=np.float64)
+        counts = np.zeros(n_days, dtype=np.int64)
+        kernel(codes, intens, sums, counts)
+        return sums, counts
+    return daily_sums_counts
+
+def plot_mood_trend_graph(df: "pd.DataFrame"):
     """
     Takes a DataFrame of mood data and returns a clean, readable Plotly line chart
     of the average mood intensity per day.
     """
+    import numpy as np
+    import pandas as pd
+
     if df is None or df.empty:
         return None
 
-    # Aggregate the data to get the average intensity for each date
-    agg_df = df.groupby('date')['intensity'].mean().reset_index()
+    # Aggregate the data to get the average intensity for each date: factorize the dates,
+    # then sum/count per code with bincount. Rows with no date or intensity are skipped,
+    # as groupby().mean() would.
+    codes, dates = pd.factorize(df['date'], sort=True)
+    intens = df['intensity'].to_numpy(dtype=np.float64, na_value=np.nan)
+    sums, counts = _daily_sums_counts_impl()(codes.astype(np.int64), intens, len(dates))
+    has_data = counts > 0
+    daily_avg = zip(dates[has_data], sums[has_data] / counts[has_data])
+    return _build_mood_trend_fig(tuple((d, float(m)) for d, m in daily_avg))
+
+@functools.lru_cache(maxsize=64)
+def _build_mood_trend_fig(daily_avg: tuple):
+    """
+    Builds the trend figure from ((date, avg_intensity), ...). Keyed on the aggregated
+    data itself, so a rerun over unchanged history reuses the already-built figure.
+    """
+    import pandas as pd
+    import plotly.express as px
+
+    agg_df = pd.DataFrame(list(daily_avg), columns=['date', 'intensity'])
 
     # Create the figure
     fig = px.line(
@@ -163,58 +379,198 @@ def plot_mood_trend_graph(df: pd.DataFrame):
 # --- END OF FIX ---
 
 
+# basic recipient validation: must contain @ and a dot
+_EMAIL_RE = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+# LLM tool input may separate fields with real newlines or literal "\n" sequences
+_NL_SPLIT = re.compile(r'\\n|\n')
+
+def _looks_like_email(s: str) -> bool:
+    if not s or not isinstance(s, str):
+        return False
+    return bool(_EMAIL_RE.match(s))
+
+def _email_precheck(to_email: str):
+    """Returns an error result if the email cannot be sent at all, otherwise None."""
+    if not _looks_like_email(to_email):
+        logger.warning("Attempted to send email to non-email recipient: %s", to_email)
+        return {"ok": False, "error": "Recipient does not appear to be an email address."}
+    if not (SENDGRID_API_KEY and SENDGRID_FROM_EMAIL):
+        return {"ok": False, "error": "SendGrid API Key or From Email is not configured in your .env file."}
+    return None
+
+def _html_body(body: str) -> str:
+    # --- THE FIX: Perform the replacement BEFORE the f-string ---
+    # This avoids the backslash syntax error in Python 3.10.
+    # Single-line bodies (most alerts) skip the replace copy.
+    body_with_breaks = body.replace('\n', '<br>') if '\n' in body else body
+    return f"<strong>{body_with_breaks}</strong>"
+
 def send_email(to_email: str, subject: str, body: str) -> Dict[str, Any]:
     """
     Send email using SendGrid API. This version is more robust and compatible with Python 3.10.
     """
-    # basic recipient validation: must contain @ and a dot
-    def _looks_like_email(s: str) -> bool:
-        if not s or not isinstance(s, str):
-            return False
-        return bool(re.match(r"[^@\s]+@[^@\s]+\.[^@\s]+", s))
+    error = _email_precheck(to_email)
+    if error:
+        return error
 
-    if not _looks_like_email(to_email):
-        logger.warning("Attempted to send email to non-email recipient: %s", to_email)
-        return {"ok": False, "error": "Recipient does not appear to be an email address."}
+    if _SG_CLIENT is None:
+        return {"ok": False, "error": "The 'sendgrid' library is not installed. Please run 'pip install sendgrid'."}
+    try:
+        html_body = _html_body(body)
+        
+        message = Mail(
+            from_email=SENDGRID_FROM_EMAIL,
+            to_emails=to_email,
+            subject=subject,
+            html_content=html_body  # Use the new, clean variable
+        )
+        
+        response = _SG_CLIENT.send(message)
+        logger.debug("SendGrid response - status: %s, body: %s", getattr(response, 'status_code', None), getattr(response, 'body', None))
+
+        if 200 <= getattr(response, 'status_code', 0) < 300:
+            logger.info("Email sent to %s (subject=%s)", to_email, subject)
+            return {"ok": True}
+        else:
+            err = f"SendGrid API error ({getattr(response, 'status_code', 'unknown')}): {getattr(response, 'body', '')}"
+            logger.error("Failed to send email: %s", err)
+            return {"ok": False, "error": err}
 
-    if SENDGRID_API_KEY and SENDGRID_FROM_EMAIL:
-        try:
-            from sendgrid import SendGridAPIClient
-            from sendgrid.helpers.mail import Mail
-
-            # --- THE FIX: Perform the replacement BEFORE the f-string ---
-            # This avoids the backslash syntax error in Python 3.10
-            body_with_breaks = body.replace('\n', '<br>')
-            html_body = f"<strong>{body_with_breaks}</strong>"
-            
-            message = Mail(
-                from_email=SENDGRID_FROM_EMAIL,
-                to_emails=to_email,
-                subject=subject,
-                html_content=html_body  # Use the new, clean variable
-            )
-            
-            sg = SendGridAPIClient(SENDGRID_API_KEY)
-            response = sg.send(message)
-            logger.debug("SendGrid response - status: %s, body: %s", getattr(response, 'status_code', None), getattr(response, 'body', None))
-
-            if 200 <= getattr(response, 'status_code', 0) < 300:
-                logger.info("Email sent to %s (subject=%s)", to_email, subject)
-                return {"ok": True}
-            else:
-                err = f"SendGrid API error ({getattr(response, 'status_code', 'unknown')}): {getattr(response, 'body', '')}"
-                logger.error("Failed to send email: %s", err)
-                return {"ok": False, "error": err}
-
-        except ImportError:
-             return {"ok": False, "error": "The 'sendgrid' library is not installed. Please run 'pip install sendgrid'."}
-        except Exception as e:
-            import traceback
-            tb = traceback.format_exc()
-            logger.exception("Exception while sending email to %s: %s", to_email, tb)
-            return {"ok": False, "error": f"A critical error occurred while sending email: {str(e)}"}
-    
-    return {"ok": False, "error": "SendGrid API Key or From Email is not configured in your .env file."}
+    except Exception as e:
+        logger.exception("Exception while sending email to %s: %s", to_email, traceback.format_exc())
+        return {"ok": False, "error": f"A critical error occurred while sending email: {str(e)}"}
+
+_PERSONALIZATIONS_PER_MAIL = 900  # SendGrid allows 1000 per request
+
+def send_emails_bulk(items: Iterable[Tuple[str, str, str]]) -> Dict[str, Any]:
+    """
+    Sends many (to_email, subject, body) emails with as few SendGrid requests as possible.
+    The v3 API carries one body per request but up to 1000 personalizations (recipient +
+    subject), so items are grouped by body and sent in chunks of _PERSONALIZATIONS_PER_MAIL.
+    Each recipient gets their own personalization, so nobody sees the other addresses.
+    Returns {"ok": bool, "sent": <count>, "errors": [..]}; invalid recipients are skipped.
+    """
+    if not (SENDGRID_API_KEY and SENDGRID_FROM_EMAIL):
+        return {"ok": False, "sent": 0, "errors": ["SendGrid API Key or From Email is not configured in your .env file."]}
+    if _SG_CLIENT is None:
+        return {"ok": False, "sent": 0, "errors": ["The 'sendgrid' library is not installed. Please run 'pip install sendgrid'."]}
+
+    by_body: Dict[str, List[Tuple[str, str]]] = {}
+    errors = []
+    for to_email, subject, body in items:
+        if not _looks_like_email(to_email):
+            logger.warning("Attempted to send email to non-email recipient: %s", to_email)
+            errors.append(f"Recipient does not appear to be an email address: {to_email}")
+            continue
+        by_body.setdefault(body, []).append((to_email, subject))
+
+    sent = 0
+    for body, recipients in by_body.items():
+        html_body = _html_body(body)
+        for i in range(0, len(recipients), _PERSONALIZATIONS_PER_MAIL):
+            chunk = recipients[i:i + _PERSONALIZATIONS_PER_MAIL]
+            message = Mail(from_email=SENDGRID_FROM_EMAIL, subject=chunk[0][1], html_content=html_body)
+            for to_email, subject in chunk:
+                p = Personalization()
+                p.add_to(To(to_email))
+                p.subject = subject
+                message.add_personalization(p)
+            try:
+                response = _SG_CLIENT.send(message)
+                if 200 <= getattr(response, 'status_code', 0) < 300:
+                    logger.info("Bulk email sent to %d recipients", len(chunk))
+                    sent += len(chunk)
+                else:
+                    err = f"SendGrid API error ({getattr(response, 'status_code', 'unknown')}): {getattr(response, 'body', '')}"
+                    logger.error("Failed to send bulk email: %s", err)
+                    errors.append(err)
+            except Exception as e:
+                logger.exception("Exception while sending bulk email to %d recipients", len(chunk))
+                errors.append(f"A critical error occurred while sending email: {str(e)}")
+    return {"ok": not errors, "sent": sent, "errors": errors}
+
+# Worker threads for email delivery so the Streamlit script thread doesn't wait on SendGrid.
+_MAIL_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="synermind-mail")
+
+def send_email_background(to_email: str, subject: str, body: str) -> Dict[str, Any]:
+    """
+    Queues send_email on a worker thread and returns immediately.
+    Recipient and configuration problems are still reported synchronously so callers can
+    fall back (e.g. show the link on screen); delivery failures are logged to email.log.
+    """
+    error = _email_precheck(to_email)
+    if error:
+        return error
+    _MAIL_POOL.submit(send_email, to_email, subject, body)
+    return {"ok": True, "queued": True}
+
+# Crisis alerts get their own workers so they never queue behind verification/reset mail.
+_ALERT_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="synermind-alert")
+
+def send_alert_future(to_email: str, subject: str, body: str) -> Future:
+    """
+    Sends an urgent alert on the dedicated alert pool and hands back the Future, so the
+    caller can check the send_email result ({"ok": ..., "error": ...}) later without blocking.
+    """
+    return _ALERT_POOL.submit(send_email, to_email, subject, body)
+
+# Alerts queued by tool_send_alert, per user id. A tool can only hand the LLM a string, so
+# the UI collects these futures (take_pending_alerts) and checks how delivery went.
+_PENDING_ALERTS: Dict[int, List[Future]] = {}
+_PENDING_ALERTS_LOCK = threading.Lock()
+
+def take_pending_alerts(user_id: int) -> List[Future]:
+    """Returns (and forgets) the alert futures tool_send_alert queued for this user."""
+    with _PENDING_ALERTS_LOCK:
+        return _PENDING_ALERTS.pop(user_id, [])
+
+# --- Async bulk delivery (operator-triggered sweeps) ---
+_SENDGRID_SEND_URL = "https://api.sendgrid.com/v3/mail/send"
+_BULK_SEND_CONCURRENCY = 10  # stay well inside SendGrid's rate limits
+
+async def send_email_async(to_email: str, subject: str, body: str, client: httpx.AsyncClient = None) -> Dict[str, Any]:
+    """
+    Async counterpart of send_email that posts straight to SendGrid's v3 REST endpoint.
+    Pass a shared httpx.AsyncClient to reuse its connection pool across sends.
+    """
+    error = _email_precheck(to_email)
+    if error:
+        return error
+    payload = {
+        "personalizations": [{"to": [{"email": to_email}]}],
+        "from": {"email": SENDGRID_FROM_EMAIL},
+        "subject": subject,
+        "content": [{"type": "text/html", "value": _html_body(body)}],
+    }
+    headers = {"Authorization": f"Bearer {SENDGRID_API_KEY}"}
+    try:
+        if client is None:
+            async with httpx.AsyncClient(timeout=15) as own_client:
+                response = await own_client.post(_SENDGRID_SEND_URL, json=payload, headers=headers)
+        else:
+            response = await client.post(_SENDGRID_SEND_URL, json=payload, headers=headers)
+        if 200 <= response.status_code < 300:
+            logger.info("Email sent to %s (subject=%s)", to_email, subject)
+            return {"ok": True}
+        err = f"SendGrid API error ({response.status_code}): {response.text}"
+        logger.error("Failed to send email: %s", err)
+        return {"ok": False, "error": err}
+    except Exception as e:
+        logger.exception("Exception while sending email to %s", to_email)
+        return {"ok": False, "error": f"A critical error occurred while sending email: {str(e)}"}
+
+async def send_alerts_bulk(alerts: Iterable[Tuple[str, str, str]]) -> List[Dict[str, Any]]:
+    """
+    Sends many (to_email, subject, body) alerts concurrently over one HTTP client,
+    at most _BULK_SEND_CONCURRENCY in flight. Returns one result dict per alert, in order.
+    """
+    sem = asyncio.Semaphore(_BULK_SEND_CONCURRENCY)
+    async with httpx.AsyncClient(timeout=15) as client:
+        async def _send(to_email, subject, body):
+            async with sem:
+                return await send_email_async(to_email, subject, body, client=client)
+        results = await asyncio.gather(*(_send(*a) for a in alerts), return_exceptions=True)
+    return [r if isinstance(r, dict) else {"ok": False, "error": str(r)} for r in results]
 
 def tool_log_mood(args: str) -> str:
     """
@@ -223,17 +579,17 @@ def tool_log_mood(args: str) -> str:
     """
     try:
         cleaned_args = args.strip().strip("'\"")
-        parts = re.split(r'\\n|\n', cleaned_args)
+        parts = _NL_SPLIT.split(cleaned_args)
         if len(parts) < 2:
             return f"ERROR: Input must contain user identifier and mood. Received: {parts}"
         # Allow username or numeric id
-        from db_models import resolve_user_identifier, add_mood
         try:
             user_id = resolve_user_identifier(parts[0].strip())
         except Exception:
             return f"ERROR: Could not resolve user identifier: {parts[0].strip()}"
         mood = parts[1].strip()
         intensity = int(parts[2].strip()) if len(parts) > 2 and parts[2].strip().isdigit() else 5
+        intensity = max(1, min(10, intensity))
         note = parts[3].strip() if len(parts) > 3 else None
         ml = add_mood(user_id=user_id, mood=mood, intensity=intensity, note=note)
         return f"OK: Mood '{mood}' was successfully logged for user {user_id}."
@@ -241,45 +597,68 @@ def tool_log_mood(args: str) -> str:
         return f"ERROR logging mood: {str(e)}. Input received: {args}"
 
 def tool_get_mood_history(args: str) -> str:
-    from db_models import get_mood_history, resolve_user_identifier
+    import pandas as pd
+
     try:
         uid = resolve_user_identifier(args.strip())
         rows = get_mood_history(uid)
-        lines = [f"On {r.created_at.strftime('%Y-%m-%d')}, mood was '{r.mood}' (intensity: {r.intensity})" for r in rows]
-        return "\n".join(lines) if lines else "No mood history found for this user."
+        if not rows:
+            return "No mood history found for this user."
+        # Format all rows with column-wise string ops instead of one f-string per row.
+        # Int64 keeps intensities integral when some are NULL, and missing values render as
+        # "None" (as str() would) so no row is dropped or changed by str.cat.
+        df = pd.DataFrame(rows, columns=["d", "m", "i"])
+        intensity = df["i"].astype("Int64")
+        out = (
+            "On " + pd.to_datetime(df["d"]).dt.strftime("%Y-%m-%d").fillna("None")
+            + ", mood was '" + df["m"].astype(str)
+            + "' (intensity: " + intensity.astype(str).mask(intensity.isna(), "None") + ")"
+        )
+        return out.str.cat(sep="\n")
     except Exception as e:
         return f"ERROR getting mood history: {str(e)}"
 
+# tool_send_alert's result starts with this only when an email was actually queued.
+ALERT_QUEUED = "ALERT queued"
+
 def tool_send_alert(args: str) -> str:
-    from db_models import create_alert, SessionLocal, User, resolve_user_identifier
     try:
         parts = args.split("\n", 2)
-        uid = resolve_user_identifier(parts[0].strip())
         subject = parts[1]
         message = parts[2] if len(parts) > 2 else ""
-        a = create_alert(user_id=uid, alert_type=subject, message=message)
-        db = SessionLocal()
-        user = db.query(User).filter(User.id == uid).first()
-        db.close()
+        # One session/transaction for resolving the user, saving the alert and reading contacts
+        with unit_of_work() as db:
+            uid = resolve_user_identifier(parts[0].strip(), db=db)
+            a = create_alert(user_id=uid, alert_type=subject, message=message, db=db)
+            user = (
+                db.query(User.username, User.email, User.emergency_contact)
+                .filter(User.id == uid)
+                .first()
+            )
         to_email = None
         if user:
             # Prefer emergency_contact if it looks like an email, otherwise fallback to the user's email
             ec = user.emergency_contact.strip() if user.emergency_contact else None
             ue = user.email.strip() if user.email else None
             # re-use send_email's internal validation by checking basic pattern here
-            if ec and re.match(r"[^@\s]+@[^@\s]+\.[^@\s]+", ec):
+            if ec and _EMAIL_RE.match(ec):
                 to_email = ec
-            elif ue and re.match(r"[^@\s]+@[^@\s]+\.[^@\s]+", ue):
+            elif ue and _EMAIL_RE.match(ue):
                 to_email = ue
 
         if not to_email:
             logger.warning("Alert saved (id=%s) but no valid recipient email found for user id %s", a.id, uid)
             return f"ALERT saved (id={a.id}) but no valid recipient email found for this user."
 
-        res = send_email(to_email, f"Synermind Alert: {subject}", f"This is an alert regarding user: {user.username}\n\n{message}")
-        if res.get("ok"):
-            return f"ALERT sent successfully to the user's emergency contact."
-        return f"Alert was saved, but the email failed to send: {res.get('error')}"
+        # Recipient/configuration problems are known now; delivery is only known once the
+        # queued send finishes, so report "queued" and leave the outcome to the future.
+        error = _email_precheck(to_email)
+        if error:
+            return f"Alert was saved, but the email failed to send: {error.get('error')}"
+        fut = send_alert_future(to_email, f"Synermind Alert: {subject}", f"This is an alert regarding user: {user.username}\n\n{message}")
+        with _PENDING_ALERTS_LOCK:
+            _PENDING_ALERTS.setdefault(uid, []).append(fut)
+        return f"{ALERT_QUEUED} for delivery to the user's emergency contact."
     except Exception as e:
         return f"ERROR sending alert: {str(e)}"
 
@@ -1,9 +1,15 @@
 # main_ui.py
+import asyncio
+import functools
+import hashlib
+import html as _html
+import re
+import statistics
+import threading
 import streamlit as st
+from cachetools import TTLCache
 import time
 from datetime import datetime
-import numpy as np
-import pandas as pd # <-- The required import for the new dashboard
 
 # --- All Necessary Imports from Your Project ---
 from db_models import (
@@ -11,15 +17,27 @@ from db_models import (
     Interaction,
     User,
     log_feedback,
+    log_turn,
     add_mood,
+    create_alert,
+    authenticate_user,
     delete_user_interactions,
     set_mfa,
-    get_user_metrics
+    get_user_metrics,
+    get_chat_history_version,
 )
-from agents import get_agents
+from agents import get_agents, bind_session_memory, run_crisis_turn, stream_conversation, stream_agent, STREAMING_AGENTS
 from router import router_chain
 # --- FIX: Import the new functions and remove the old one ---
-from llm_tools import get_mood_insights_data, plot_mood_trend_graph, get_mood_extractor_chain
+from llm_tools import (
+    get_mood_insights_data,
+    plot_mood_trend_graph,
+    get_mood_extractor_chain,
+    run_async,
+    contains_crisis_keywords,
+    send_alert_future,
+    take_pending_alerts,
+)
 from security import (
     new_totp_secret,
     totp_provisioning_uri,
@@ -27,68 +45,436 @@ from security import (
     verify_totp
 )
 
-# Use Streamlit's cache to create agents once per user session
-@st.cache_resource
-def load_agents_for_session():
-    return get_agents()
-
 @st.cache_resource
 def load_extractor_chain():
     return get_mood_extractor_chain()
 
+@st.cache_resource
+def _agent_response_cache():
+    """
+    Process-wide, bounded cache of agent replies (entries expire after 5 minutes),
+    shared by all sessions; keys include the user id, so replies never cross users.
+    TTLCache isn't thread-safe, so it comes with a lock.
+    """
+    return TTLCache(maxsize=4096, ttl=300), threading.Lock()
+
+# Agents whose replies must never come from the cache: crisis turns have to run the alert
+# every time, and routine replies depend on live tool output (mood history).
+_UNCACHED_AGENTS = frozenset({"crisis", "routine"})
+
+# Response-cache keys: an in-memory lookup doesn't need a cryptographic hash, so use
+# 128-bit blake2b over the user id, label, message and the tail of the context.
+_KEY_SEP = b"||"
+_KEY_CONTEXT_CHARS = 4000
+
+@functools.lru_cache(maxsize=32)
+def _label_bytes(agent_label: str) -> bytes:
+    return agent_label.encode('utf-8') + _KEY_SEP
+
+def make_cache_key(user_id: int, agent_label: str, user_msg_bytes: bytes, context_text: str) -> str:
+    """user_msg_bytes is the message's UTF-8 encoding, stored on it as "_bytes" when appended."""
+    h = hashlib.blake2b(b"%d" % user_id + _KEY_SEP, digest_size=16)
+    h.update(_label_bytes(agent_label))
+    h.update(user_msg_bytes)
+    h.update(_KEY_SEP)
+    h.update(context_text[-_KEY_CONTEXT_CHARS:].encode('utf-8'))
+    return h.hexdigest()
+
+# Real token counts when tiktoken (optional) is available. cl100k_base isn't the Groq/Gemini
+# tokenizer, but it's far closer than chars/4. get_encoding may need to download its
+# ranks file, so any failure falls back to the heuristic.
+try:
+    import tiktoken
+    _ENC = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _ENC = None
+
+def _message_tokens(m) -> int:
+    """Token count of one history line, computed once and kept on the message as "_tok"."""
+    n = m.get("_tok")
+    if n is None:
+        content = m.get("content") or ""
+        if _ENC is not None:
+            n = len(_ENC.encode_ordinary(content)) + 3  # + "Human: "/"AI: " prefix and newline
+        else:
+            n = (len(content) + 8) // 4 + 1
+        m["_tok"] = n
+    return n
+
+def _context_start(history, max_tokens=800) -> int:
+    """
+    Index of the oldest message kept when trimming history to the most recent max_tokens.
+    Per-message token counts are cached on the messages, so nothing is formatted here.
+    """
+    total = 0
+    start = len(history)
+    for i in range(len(history) - 1, -1, -1):
+        n = _message_tokens(history[i])
+        if total + n > max_tokens:
+            break
+        total += n
+        start = i
+    return start
+
+def _format_context(messages) -> str:
+    """Messages as "Human: ..."/"AI: ..." lines for the router and agent prompts."""
+    return "\n".join(
+        f"{'Human' if m['role'] == 'user' else 'AI'}: {m['content']}" for m in messages
+    )
+
+def _message_crisis(m) -> bool:
+    """contains_crisis_keywords for one message, computed once and kept on it as "_crisis"."""
+    flag = m.get("_crisis")
+    if flag is None:
+        flag = m["_crisis"] = contains_crisis_keywords(m.get("content") or "")
+    return flag
+
 def load_chat_history(user_id: int):
-    """Loads chat history for a specific user from the database."""
+    """
+    Loads chat history for a specific user. The full SELECT is cached and keyed on the
+    history's (count, max id), so it only re-runs after messages are added or deleted.
+    """
+    count, last_id = get_chat_history_version(user_id)
+    return _load_chat_history_cached(user_id, count, last_id)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _load_chat_history_cached(user_id: int, count: int, last_id: int):
     db = SessionLocal()
     try:
+        # Only the three displayed columns, streamed in batches rather than full Interaction rows
         rows = (
-            db.query(Interaction)
+            db.query(Interaction.user_msg, Interaction.agent_reply, Interaction.agent_type)
             .filter(Interaction.user_id == user_id, Interaction.agent_type != "feedback")
             .order_by(Interaction.created_at.asc())
-            .all()
+            .yield_per(200)
         )
         history = []
-        for r in rows:
-            history.append({"role": "user", "content": r.user_msg})
-            history.append({"role": "assistant", "avatar": "🤖", "content": r.agent_reply, "agent": r.agent_type})
+        for user_msg, agent_reply, agent_type in rows:
+            history.append({"role": "user", "content": user_msg})
+            history.append({"role": "assistant", "avatar": "🤖", "content": agent_reply, "agent": agent_type})
         return history
     finally:
         db.close()
 
+async def classify_turn(mood_extractor, user_msg: str, router_input: str, last_agent: str = "", crisis=None):
+    """
+    Runs mood extraction and routing concurrently; they don't depend on each other.
+    `crisis` is passed through to the router (see _RouterChainAdapter.arun).
+    Returns (extracted_mood or None, agent_label).
+    """
+    async def aextract():
+        try:
+            return (await mood_extractor.arun(user_msg)).strip().lower()
+        except Exception as e:
+            print(f"Mood extraction failed: {e}")
+            return None
+    return await asyncio.gather(aextract(), router_chain.arun(router_input, last_agent, crisis))
+
+_INT_RE = re.compile(r'\b([1-9]|10)\b')
+_WORD_RE = re.compile(r"[a-z]+")
+_HIGH = frozenset({"very", "extremely", "overwhelmed", "panic", "terrified", "intense", "severe", "horrible"})
+_MED_HIGH = frozenset({"anxious", "anxiety", "stressed", "panic", "scared", "worried"})
+_LOW = frozenset({"bit", "little", "slightly", "calm", "okay", "fine", "neutral"})
+
 def estimate_intensity_from_text(text: str) -> int:
     """Heuristic estimate 1-10 intensity from short user text (conservative)."""
     if not text:
         return 5
     t = text.lower()
-    import re
-    m = re.search(r'\b([1-9]|10)\b', t)
+    m = _INT_RE.search(t)
     if m:
         try:
             v = int(m.group(1))
             return max(1, min(10, v))
         except Exception:
             pass
-    high = ["very", "extremely", "overwhelmed", "panic", "panic attack", "terrified", "intense", "severe", "horrible"]
-    med_high = ["anxious", "anxiety", "stressed", "panic", "scared", "worried"]
-    low = ["bit", "little", "slightly", "calm", "okay", "fine", "neutral"]
+    # Tokenize once, then each keyword group is a single set intersection
+    tokens = set(_WORD_RE.findall(t))
     score = 5
-    for kw in high:
-        if kw in t:
-            score = max(score, 8)
-    for kw in med_high:
-        if kw in t:
-            score = max(score, 6)
-    for kw in low:
-        if kw in t:
-            score = min(score, 3)
+    if tokens & _HIGH or "panic attack" in t:
+        score = max(score, 8)
+    if tokens & _MED_HIGH:
+        score = max(score, 6)
+    if tokens & _LOW:
+        score = min(score, 3)
     if "!!!" in t or "!!" in t:
         score = min(10, score + 2)
     if t.count("?") >= 2 and score < 8:
         score += 1
     return max(1, min(10, int(score)))
 
+def _render_bubble(role, content, agent=None) -> str:
+    """Builds the HTML for one chat bubble: assistant on the right, user on the left."""
+    # Escape any HTML in content so user-supplied or model-supplied tags
+    # don't break the page layout. Preserve newlines as <br>.
+    safe_content = _html.escape(content or "").replace("\n", "<br>")
+    if role == 'assistant':
+        # Agent on the right
+        return f'''
+        <div class="chat-row">
+            <div class="right-col" style="width:100%">
+                <div class="chat-bubble agent">
+                    {f"<div style='font-size:0.82em;color:#2b556a;margin-bottom:6px;font-weight:600;text-align:right;'>{agent.capitalize()} Agent</div>" if agent else ''}
+                    {safe_content}
+                </div>
+            </div>
+        </div>
+        '''
+    # User on the left
+    return f'''
+    <div class="chat-row">
+        <div class="left-col" style="width:100%">
+            <div class="chat-bubble user">
+                {safe_content}
+            </div>
+        </div>
+    </div>
+    '''
+
+def render_chat():
+    """
+    Renders the chat history. Each bubble's HTML is built once and kept on its message
+    dict under "_html", so reruns only re-emit strings instead of re-escaping every message.
+    """
+    st.markdown('<div class="chat-wrapper">', unsafe_allow_html=True)
+    for message in st.session_state.chat_history:
+        html = message.get("_html") or message.setdefault(
+            "_html", _render_bubble(message.get("role"), message.get("content"), message.get("agent"))
+        )
+        st.markdown(html, unsafe_allow_html=True)
+    st.markdown('</div>', unsafe_allow_html=True)
+
+def _pending_crisis_alerts() -> list:
+    """
+    Crisis alerts still being sent in the background for this session: the chat bypass's own
+    send plus any the crisis agent's send_alert tool queued (collected from llm_tools).
+    """
+    pending = st.session_state.get('_crisis_futs', [])
+    user = st.session_state.get("user")
+    if user:
+        queued = take_pending_alerts(user["id"])
+        if queued:
+            pending = pending + queued
+            st.session_state['_crisis_futs'] = pending
+    return pending
+
+def _poll_crisis_alert() -> bool:
+    """
+    Checks the crisis alerts being sent in the background. Finished ones are cleared; if a
+    send failed, the reason is stored in crisis_error. Returns True on failure.
+    """
+    pending = _pending_crisis_alerts()
+    if not pending:
+        return False
+    still_pending = []
+    error = None
+    for fut in pending:
+        if not fut.done():
+            still_pending.append(fut)
+            continue
+        try:
+            res = fut.result()
+        except Exception as e:
+            res = {"ok": False, "error": str(e)}
+        if not res.get("ok"):
+            error = res.get('error')
+    if still_pending:
+        st.session_state['_crisis_futs'] = still_pending
+    else:
+        st.session_state.pop('_crisis_futs', None)
+    if error is None:
+        return False
+    st.session_state['crisis_error'] = f"The send_email function failed. Reason: {error}"
+    return True
+
+@st.fragment(run_every=2)
+def _crisis_alert_status():
+    """
+    Polls pending crisis alerts every 2 seconds while the chat page is open, so a failed
+    send is surfaced even if the user keeps chatting (chat turns only rerun the page fragment).
+    """
+    if _poll_crisis_alert():
+        st.rerun()  # full run, so render_main_ui shows the crisis_error banner
+
+@st.fragment
+def render_chat_page(user):
+    """
+    The Chat page. Runs as a fragment so sending a message only reruns this part of
+    the page, not the auth gate, styles and sidebar around it.
+    """
+    st.title(f"Synermind Wellness Chat")
+
+    if _pending_crisis_alerts():
+        _crisis_alert_status()
+
+    render_chat()
+
+    if not st.session_state.get("chat_ended"):
+        AGENTS = get_agents()
+        mood_extractor = load_extractor_chain()
+
+        user_msg = st.chat_input("How are you feeling today?")
+        if user_msg:
+            user_entry = {
+                "role": "user",
+                "content": user_msg,
+                "_html": _render_bubble("user", user_msg),
+                "_bytes": user_msg.encode('utf-8'),
+            }
+            st.session_state.chat_history.append(user_entry)
+            with st.chat_message("user"):
+                st.markdown(user_msg)
+
+            # --- CRISIS BYPASS: If crisis keywords detected, send alert directly ---
+            if _message_crisis(user_entry):
+                # Contacts are cached in the session at sign-in; older sessions look them up once.
+                if "email" not in user:
+                    db = SessionLocal()
+                    row = (
+                        db.query(User.email, User.emergency_contact)
+                        .filter(User.id == user["id"])
+                        .first()
+                    )
+                    db.close()
+                    user["email"], user["emergency_contact"] = row if row else (None, None)
+
+                to_email = user.get("emergency_contact") or None
+
+                # Fallback to user's own email if emergency contact is blank
+                if not to_email:
+                    to_email = user.get("email")
+
+                if to_email:
+                    # Attempt to send the email
+                    create_alert(user_id=user["id"], alert_type="CRISIS ALERT: User expresses intent for self-harm", message=user_msg)
+                    # Send on a worker thread so the reassurance message shows right away;
+                    # _poll_crisis_alert reports a failed send once it has finished.
+                    st.session_state.setdefault('_crisis_futs', []).append(send_alert_future(to_email, "Synermind Alert: CRISIS ALERT", f"This is an alert regarding user: {user['username']}\n\nUser message: {user_msg}"))
+
+                else:
+                    st.session_state['crisis_error'] = "FINAL ERROR: No emergency contact OR primary email could be found for this user. Cannot send alert."
+
+                # Display a safe message to the user and rerun the whole page so any
+                # crisis_error set above is shown (it's rendered outside this fragment)
+                crisis_reply = "It sounds like you are in distress. An alert has been dispatched to your emergency contact. Please reach out to a trusted person or a crisis hotline immediately."
+                st.session_state.chat_history.append({"role": "assistant", "avatar": "🤖", "content": crisis_reply, "agent": "crisis", "_html": _render_bubble("assistant", crisis_reply, "crisis")})
+                st.rerun()
+            # --- Otherwise, normal agent flow ---
+            with st.chat_message("assistant", avatar="🤖"):
+                with st.spinner("Thinking..."):
+                    recent_history = st.session_state.chat_history
+                    context_start = _context_start(recent_history, max_tokens=800)
+                    context = recent_history[context_start:]
+                    context_text = _format_context(context)
+                    # The router's crisis check, from flags each message got the first time it was
+                    # scanned (this turn's message was just checked above), not a rescan of the context.
+                    context_crisis = any(_message_crisis(m) for m in context)
+                    # Ensure agents (especially the Crisis agent) have the current user's identifier
+                    # The Crisis agent's tool expects the ACTION INPUT to begin with the user identifier
+                    # (username or numeric id). Prepend this info so the agent can call tools reliably.
+                    user_ident_line = f"User-Identifier: {user['username']} (id:{user['id']})"
+                    router_input = user_ident_line + "\n" + context_text + f"\nHuman: {user_msg}"
+                    # Mood extraction and routing are independent LLM calls: run them together.
+                    last_agent = st.session_state.get("last_agent_used", "")
+                    extracted_mood, agent_label = run_async(
+                        classify_turn(mood_extractor, user_msg, router_input, last_agent, context_crisis)
+                    )
+                    # The mood is written together with the interaction at the end of the turn
+                    turn_mood = extracted_mood if extracted_mood and extracted_mood != "none" else None
+                    estimated_intensity = 5
+                    if turn_mood:
+                        try:
+                            estimated_intensity = estimate_intensity_from_text(user_msg)
+                        except Exception:
+                            estimated_intensity = 5
+                    if agent_label != last_agent and last_agent != "":
+                        st.toast(f"Switched to {agent_label.capitalize()} Agent", icon="🤖")
+                    st.session_state.last_agent_used = agent_label
+                    agent_name = agent_label if agent_label in AGENTS else "mood"
+                    agent = bind_session_memory(agent_name, AGENTS[agent_name], user["id"])
+                    MAX_RETRIES = 3
+                    backoff = 1.0
+                    response = None
+                    streamed = False
+                    start_time = time.time()
+                    use_cache = agent_name not in _UNCACHED_AGENTS
+                    cache_key = make_cache_key(user["id"], agent_label, user_entry["_bytes"], context_text)
+                    # Built once: a retry after a rate limit resends exactly the same prompt
+                    prompt = f"{context_text}\nHuman: {user_msg}\nPlease be concise and practical in your reply (limit to 150 tokens)."
+                    response_cache, response_cache_lock = _agent_response_cache()
+                    if use_cache:
+                        with response_cache_lock:
+                            response = response_cache.get(cache_key)
+                    if response is None:
+                        for attempt in range(1, MAX_RETRIES + 1):
+                            try:
+                                if agent_name == "crisis":
+                                    response = run_crisis_turn(user["id"], user_msg)
+                                elif agent_name in STREAMING_AGENTS:
+                                    # Show tokens as they arrive instead of waiting for the full reply
+                                    response = st.write_stream(stream_conversation(agent, prompt))
+                                    streamed = True
+                                else:
+                                    # Tool-using agent: the reply is written as soon as its loop finishes
+                                    response = st.write_stream(stream_agent(agent, prompt))
+                                    streamed = True
+                                if use_cache:
+                                    with response_cache_lock:
+                                        response_cache[cache_key] = response
+                                break
+                            except Exception as e:
+                                    err_text = str(e).lower()
+                                    # Detect rate limits and retry as before
+                                    if 'rate' in err_text and ('limit' in err_text or 'rate_limit' in err_text or 'rate-limit' in err_text):
+                                        if attempt == MAX_RETRIES:
+                                            st.error("The language model is temporarily busy due to rate limits. Please wait a moment and try again.")
+                                            response = "I'm having trouble accessing the language model right now. Please try again shortly."
+                                        else:
+                                            time.sleep(backoff)
+                                            backoff *= 2
+                                            continue
+
+                                    # Detect authentication errors (invalid API key / unauthorized)
+                                    if ('invalid api key' in err_text) or ('invalid_api_key' in err_text) or ('unauthorized' in err_text) or ('authenticationerror' in err_text) or ('authentication error' in err_text):
+                                        # Surface a user-friendly error in the UI and avoid crashing
+                                        st.error("Language model authentication failed (invalid or missing API key). Please check your GROQ/GEMINI API configuration.")
+                                        st.session_state['__llm_auth_error'] = err_text
+                                        response = "I'm temporarily unable to access the language model due to configuration. Please notify the administrator or check the API keys."
+                                        break
+
+                                    # Unknown error: re-raise so it surfaces (developer will see full traceback)
+                                    raise
+                    end_time = time.time()
+                    st.session_state.response_times.append(end_time - start_time)
+                    log_turn(
+                        user_id=user['id'], agent_type=agent_label, user_msg=user_msg, agent_reply=response,
+                        mood=turn_mood, intensity=estimated_intensity,
+                    )
+                    if turn_mood:
+                        st.toast(f"Mood logged: {turn_mood.capitalize()} (intensity {estimated_intensity})", icon="📝")
+                    if not streamed:
+                        st.markdown(response)
+                    st.session_state.chat_history.append({"role": "assistant", "avatar": "🤖", "content": response, "agent": agent_label, "_html": _render_bubble("assistant", response, agent_label)})
+            if 'crisis_error' in st.session_state:
+                st.rerun()  # full run: the crisis_error banner is rendered outside this fragment
+            st.rerun(scope="fragment")
+    else:
+        # Feedback UI...
+        st.subheader("Thank you for chatting!")
+        st.write("Your feedback helps us improve.")
+        feedback_rating = st.slider("How helpful was this session?", 1, 5, 3)
+        emojis = {1: "😔", 2: "😕", 3: "😐", 4: "🙂", 5: "😃"}
+        st.markdown(f"<p style='text-align: center; font-size: 5rem;'>{emojis[feedback_rating]}</p>", unsafe_allow_html=True)
+        feedback_comment = st.text_area("Any additional comments? (Optional)")
+        if st.button("Submit Feedback"):
+            log_feedback(user_id=user['id'], rating=feedback_rating, comment=feedback_comment)
+            st.success("Feedback submitted! Thank you."); st.balloons(); time.sleep(2); st.rerun()
+
 def render_main_ui():
     user = st.session_state.user
 
+    _poll_crisis_alert()
+
 # --- ADD THIS BLOCK TO DISPLAY THE PERMANENT ERROR ---
     if 'crisis_error' in st.session_state:
         st.error(st.session_state['crisis_error'])
@@ -116,6 +502,7 @@ def render_main_ui():
             st.session_state.chat_ended = False
             st.session_state.chat_history = []
             st.session_state.last_agent_used = ""
+            st.session_state.pop("__agent_memory", None)
             st.rerun()
 
     if st.sidebar.button("Logout"):
@@ -150,198 +537,7 @@ def render_main_ui():
 
     # --- Page Content ---
     if page == "Chat":
-        st.title(f"Synermind Wellness Chat")
-
-        st.markdown('<div class="chat-wrapper">', unsafe_allow_html=True)
-        import html as _html
-        for message in st.session_state.chat_history:
-            role = message.get("role")
-            content = message.get("content") or ""
-            agent = message.get("agent", None)
-            # Escape any HTML in content so user-supplied or model-supplied tags
-            # don't break the page layout. Preserve newlines as <br>.
-            safe_content = _html.escape(content)
-            safe_content = safe_content.replace("\n", "<br>")
-
-            if role == 'assistant':
-                # Agent on the right
-                html = f'''
-                <div class="chat-row">
-                    <div class="right-col" style="width:100%">
-                        <div class="chat-bubble agent">
-                            {f"<div style='font-size:0.82em;color:#2b556a;margin-bottom:6px;font-weight:600;text-align:right;'>{agent.capitalize()} Agent</div>" if agent else ''}
-                            {safe_content}
-                        </div>
-                    </div>
-                </div>
-                '''
-                st.markdown(html, unsafe_allow_html=True)
-            else:
-                # User on the left
-                html = f'''
-                <div class="chat-row">
-                    <div class="left-col" style="width:100%">
-                        <div class="chat-bubble user">
-                            {safe_content}
-                        </div>
-                    </div>
-                </div>
-                '''
-                st.markdown(html, unsafe_allow_html=True)
-        st.markdown('</div>', unsafe_allow_html=True)
-
-        if not st.session_state.get("chat_ended"):
-            AGENTS = load_agents_for_session()
-            mood_extractor = load_extractor_chain()
-
-            user_msg = st.chat_input("How are you feeling today?")
-            if user_msg:
-                st.session_state.chat_history.append({"role": "user", "content": user_msg})
-                with st.chat_message("user"):
-                    st.markdown(user_msg)
-
-                # --- CRISIS BYPASS: If crisis keywords detected, send alert directly ---
-                from llm_tools import contains_crisis_keywords, send_email
-                if contains_crisis_keywords(user_msg):
-                    import db_models
-                    db = db_models.SessionLocal()
-                    user_obj = db.query(db_models.User).filter(db_models.User.id == user["id"]).first()
-                    db.close()
-
-                    to_email = user_obj.emergency_contact if user_obj and user_obj.emergency_contact else None
-                    
-                    # Fallback to user's own email if emergency contact is blank
-                    if not to_email and user_obj:
-                        to_email = user_obj.email
-
-                    if to_email:
-                        # Attempt to send the email
-                        db_models.create_alert(user_id=user["id"], alert_type="CRISIS ALERT: User expresses intent for self-harm", message=user_msg)
-                        res = send_email(to_email, "Synermind Alert: CRISIS ALERT", f"This is an alert regarding user: {user_obj.username}\n\nUser message: {user_msg}")
-                        
-                        # --- THIS IS THE FIX ---
-                        # If the email fails, store the error in session_state before rerunning
-                        if not res.get("ok"):
-                            st.session_state['crisis_error'] = f"The send_email function failed. Reason: {res.get('error')}"
-                        # ---------------------
-
-                    else:
-                        st.session_state['crisis_error'] = "FINAL ERROR: No emergency contact OR primary email could be found for this user. Cannot send alert."
-                    
-                    # Display a safe message to the user and rerun the page
-                    st.session_state.chat_history.append({"role": "assistant", "avatar": "🤖", "content": "It sounds like you are in distress. An alert has been dispatched to your emergency contact. Please reach out to a trusted person or a crisis hotline immediately.", "agent": "crisis"})
-                    st.rerun()
-                # --- Otherwise, normal agent flow ---
-                with st.chat_message("assistant", avatar="🤖"):
-                    with st.spinner("Thinking..."):
-                        try:
-                            extracted_mood = mood_extractor.run(user_msg).strip().lower()
-                            if extracted_mood and extracted_mood != "none":
-                                try:
-                                    estimated_intensity = estimate_intensity_from_text(user_msg)
-                                except Exception:
-                                    estimated_intensity = 5
-                                add_mood(user_id=user['id'], mood=extracted_mood,intensity = estimated_intensity)
-                                st.toast(f"Mood logged: {extracted_mood.capitalize()} (intensity { estimated_intensity})", icon="📝")
-                        except Exception as e:
-                            print(f"Mood extraction failed: {e}")
-
-                        import hashlib
-                        def estimate_tokens(text: str) -> int:
-                            if not text:
-                                return 0
-                            return max(1, int(len(text) / 4))
-                        def trim_history_by_tokens(history, max_tokens=800):
-                            lines = []
-                            total = 0
-                            for m in reversed(history):
-                                line = f"{'Human' if m['role']=='user' else 'AI'}: {m['content']}"
-                                t = estimate_tokens(line)
-                                if total + t > max_tokens:
-                                    break
-                                lines.append(line)
-                                total += t
-                            return "\n".join(reversed(lines))
-                        if "response_cache" not in st.session_state:
-                            st.session_state.response_cache = {}
-                        def make_cache_key(agent_label: str, user_msg: str, context_text: str):
-                            h = hashlib.sha256()
-                            h.update(agent_label.encode('utf-8'))
-                            h.update(b"||")
-                            h.update(user_msg.encode('utf-8'))
-                            h.update(b"||")
-                            h.update(context_text.encode('utf-8'))
-                            return h.hexdigest()
-                        recent_history = st.session_state.chat_history
-                        context_text = trim_history_by_tokens(recent_history, max_tokens=800)
-                        # Ensure agents (especially the Crisis agent) have the current user's identifier
-                        # The Crisis agent's tool expects the ACTION INPUT to begin with the user identifier
-                        # (username or numeric id). Prepend this info so the agent can call tools reliably.
-                        user_ident_line = f"User-Identifier: {user['username']} (id:{user['id']})"
-                        router_input = user_ident_line + "\n" + context_text + f"\nHuman: {user_msg}"
-                        agent_label = router_chain.run(router_input)
-                        last_agent = st.session_state.get("last_agent_used", "")
-                        if agent_label != last_agent and last_agent != "":
-                            st.toast(f"Switched to {agent_label.capitalize()} Agent", icon="🤖")
-                        st.session_state.last_agent_used = agent_label
-                        agent = AGENTS.get(agent_label, AGENTS["mood"])
-                        MAX_RETRIES = 3
-                        backoff = 1.0
-                        response = None
-                        start_time = time.time()
-                        cache_key = make_cache_key(agent_label, user_msg, context_text)
-                        cache_entry = st.session_state.response_cache.get(cache_key)
-                        if cache_entry:
-                            cached_response, cached_ts = cache_entry
-                            if time.time() - cached_ts < 300:
-                                response = cached_response
-                        if response is None:
-                            for attempt in range(1, MAX_RETRIES + 1):
-                                try:
-                                    prompt = f"{context_text}\nHuman: {user_msg}\nPlease be concise and practical in your reply (limit to 150 tokens)."
-                                    response = agent.run(input=prompt)
-                                    st.session_state.response_cache[cache_key] = (response, time.time())
-                                    break
-                                except Exception as e:
-                                        err_text = str(e).lower()
-                                        # Detect rate limits and retry as before
-                                        if 'rate' in err_text and ('limit' in err_text or 'rate_limit' in err_text or 'rate-limit' in err_text):
-                                            if attempt == MAX_RETRIES:
-                                                st.error("The language model is temporarily busy due to rate limits. Please wait a moment and try again.")
-                                                response = "I'm having trouble accessing the language model right now. Please try again shortly."
-                                            else:
-                                                time.sleep(backoff)
-                                                backoff *= 2
-                                                continue
-
-                                        # Detect authentication errors (invalid API key / unauthorized)
-                                        if ('invalid api key' in err_text) or ('invalid_api_key' in err_text) or ('unauthorized' in err_text) or ('authenticationerror' in err_text) or ('authentication error' in err_text):
-                                            # Surface a user-friendly error in the UI and avoid crashing
-                                            st.error("Language model authentication failed (invalid or missing API key). Please check your GROQ/GEMINI API configuration.")
-                                            st.session_state['__llm_auth_error'] = err_text
-                                            response = "I'm temporarily unable to access the language model due to configuration. Please notify the administrator or check the API keys."
-                                            break
-
-                                        # Unknown error: re-raise so it surfaces (developer will see full traceback)
-                                        raise
-                        end_time = time.time()
-                        st.session_state.response_times.append(end_time - start_time)
-                        from db_models import log_interaction
-                        log_interaction(user_id=user['id'], agent_type=agent_label, user_msg=user_msg, agent_reply=response)
-                        st.markdown(response)
-                        st.session_state.chat_history.append({"role": "assistant", "avatar": "🤖", "content": response, "agent": agent_label})
-                st.rerun()
-        else:
-            # Feedback UI...
-            st.subheader("Thank you for chatting!")
-            st.write("Your feedback helps us improve.")
-            feedback_rating = st.slider("How helpful was this session?", 1, 5, 3)
-            emojis = {1: "😔", 2: "😕", 3: "😐", 4: "🙂", 5: "😃"}
-            st.markdown(f"<p style='text-align: center; font-size: 5rem;'>{emojis[feedback_rating]}</p>", unsafe_allow_html=True)
-            feedback_comment = st.text_area("Any additional comments? (Optional)")
-            if st.button("Submit Feedback"):
-                log_feedback(user_id=user['id'], rating=feedback_rating, comment=feedback_comment)
-                st.success("Feedback submitted! Thank you."); st.balloons(); time.sleep(2); st.rerun()
+        render_chat_page(user)
 
     elif page == "Mood Logger":
         st.header("Manual Mood Logger")
@@ -374,24 +570,18 @@ def render_main_ui():
             # 3. Display the Detailed Mood Log
             st.subheader("Detailed Mood Log")
             
-            # Prepare the DataFrame for display
-            display_df = df[['date', 'time', 'mood', 'intensity']].copy()
-            display_df.rename(
-                columns={
+            # Newest entries first: one int64 sort on the timestamp key, then select and rename
+            display_df = (
+                df.sort_values("_dt", ascending=False, kind="stable")
+                .loc[:, ['date', 'time', 'mood', 'intensity']]
+                .rename(columns={
                     'date': 'Date',
                     'time': 'Time',
                     'mood': 'Mood',
                     'intensity': 'Intensity (1-10)'
-                },
-                inplace=True
-            )
-            
-            # Display the table, newest entries first
-            st.dataframe(
-                display_df.sort_values(by=['Date', 'Time'], ascending=[False, False]),
-                use_container_width=True,
-                hide_index=True
+                })
             )
+            st.dataframe(display_df, use_container_width=True, hide_index=True)
 
     elif page == "Metrics & Insights":
         st.title("📊 Your Metrics & Insights")
@@ -414,7 +604,7 @@ def render_main_ui():
         with colA:
             st.subheader("Response Time (Latency)")
             if st.session_state.response_times:
-                avg_response_time = np.mean(st.session_state.response_times)
+                avg_response_time = statistics.fmean(st.session_state.response_times)
                 st.metric("Avg. Response Time (Current Session)", f"{avg_response_time:.2f} sec")
             else:
                 st.info("No responses yet in this session. Latency will be measured as you chat.")
@@ -425,49 +615,57 @@ def render_main_ui():
 
     elif page == "Security (MFA)":
         st.header("Multi-Factor Authentication (MFA)")
-        db = SessionLocal()
-        try:
-            u = db.query(User).filter(User.id == user['id']).first()
-            if u:
-                if not u.mfa_enabled:
-                    st.info("Enhance your account security by enabling MFA. You will need an authenticator app (like Google Authenticator or Authy).")
-                    if st.button("Enable MFA"):
-                        secret = new_totp_secret()
-                        st.session_state["__pending_mfa_secret"] = secret
-                        uri = totp_provisioning_uri(secret, u.username, "Synermind")
-                        img = qr_png_data_uri(uri)
-                        st.image(img, caption="1. Scan this QR code in your authenticator app")
-                        st.code(secret, language=None)
-                        st.markdown("2. Enter the 6-digit code from your app below to confirm.")
-                    
-                    if "__pending_mfa_secret" in st.session_state:
-                        secret = st.session_state["__pending_mfa_secret"]
-                        with st.form("confirm_mfa"):
-                            code = st.text_input("6-Digit Code")
-                            if st.form_submit_button("Confirm and Activate MFA"):
-                                if verify_totp(secret, code):
-                                    set_mfa(u.id, True, secret)
-                                    del st.session_state["__pending_mfa_secret"]
-                                    st.success("MFA has been enabled!")
-                                    time.sleep(1); st.rerun()
-                                else:
-                                    st.error("Invalid code. Please try again.")
-                else:
-                    st.success("MFA is currently enabled on your account.")
-                    if st.button("Disable MFA"):
-                        st.session_state.confirm_disable_mfa = True
-                    if st.session_state.get("confirm_disable_mfa"):
-                        st.warning("Are you sure you want to disable MFA?")
-                        with st.form("disable_mfa_form"):
-                            password = st.text_input("Enter your password to confirm", type="password")
-                            if st.form_submit_button("Yes, Disable MFA", type="primary"):
-                                from db_models import authenticate_user
-                                if authenticate_user(u.username, password):
-                                    set_mfa(u.id, False, None)
-                                    del st.session_state.confirm_disable_mfa
-                                    st.success("MFA disabled.")
-                                    time.sleep(1); st.rerun()
-                                else:
-                                    st.error("Incorrect password.")
-        finally:
-            db.close()
\ No newline at end of file
+        # Fetched once and kept in the session: the forms below rerun the page on every
+        # submit, and MFA state only changes through set_mfa, which drops this copy.
+        u = st.session_state.get("_mfa_user")
+        if u is None or u["id"] != user['id']:
+            with SessionLocal() as db:
+                row = (
+                    db.query(User.id, User.username, User.mfa_enabled)
+                    .filter(User.id == user['id'])
+                    .first()
+                )
+            u = {"id": row.id, "username": row.username, "mfa_enabled": row.mfa_enabled} if row else None
+            st.session_state["_mfa_user"] = u
+        if u:
+            if not u["mfa_enabled"]:
+                st.info("Enhance your account security by enabling MFA. You will need an authenticator app (like Google Authenticator or Authy).")
+                if st.button("Enable MFA"):
+                    secret = new_totp_secret()
+                    st.session_state["__pending_mfa_secret"] = secret
+                    uri = totp_provisioning_uri(secret, u["username"], "Synermind")
+                    img = qr_png_data_uri(uri)
+                    st.image(img, caption="1. Scan this QR code in your authenticator app")
+                    st.code(secret, language=None)
+                    st.markdown("2. Enter the 6-digit code from your app below to confirm.")
+                
+                if "__pending_mfa_secret" in st.session_state:
+                    secret = st.session_state["__pending_mfa_secret"]
+                    with st.form("confirm_mfa"):
+                        code = st.text_input("6-Digit Code")
+                        if st.form_submit_button("Confirm and Activate MFA"):
+                            if verify_totp(secret, code):
+                                set_mfa(u["id"], True, secret)
+                                del st.session_state["__pending_mfa_secret"]
+                                st.session_state.pop("_mfa_user", None)
+                                st.success("MFA has been enabled!")
+                                time.sleep(1); st.rerun()
+                            else:
+                                st.error("Invalid code. Please try again.")
+            else:
+                st.success("MFA is currently enabled on your account.")
+                if st.button("Disable MFA"):
+                    st.session_state.confirm_disable_mfa = True
+                if st.session_state.get("confirm_disable_mfa"):
+                    st.warning("Are you sure you want to disable MFA?")
+                    with st.form("disable_mfa_form"):
+                        password = st.text_input("Enter your password to confirm", type="password")
+                        if st.form_submit_button("Yes, Disable MFA", type="primary"):
+                            if authenticate_user(u["username"], password):
+                                set_mfa(u["id"], False, None)
+                                del st.session_state.confirm_disable_mfa
+                                st.session_state.pop("_mfa_user", None)
+                                st.success("MFA disabled.")
+                                time.sleep(1); st.rerun()
+                            else:
+                                st.error("Incorrect password.")
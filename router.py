@@ -1,7 +1,10 @@
 # router.py
+import hashlib
+import threading
+from collections import OrderedDict
 from langchain.prompts import PromptTemplate
 from langchain.chains import LLMChain
-from llm_tools import get_llm_provider, contains_crisis_keywords
+from llm_tools import get_llm_provider, contains_crisis_keywords, run_async
 
 # Create a high-reasoning LLM instance specifically for routing, using Gemini.
 llm_router = get_llm_provider(provider="gemini", model_name="gemini-2.5-flash", temperature=0.0)
@@ -36,15 +39,47 @@ def _normalize_label(text: str) -> str:
 
 _chain = LLMChain(llm=llm_router, prompt=router_prompt, verbose=False)
 
+# LRU of recent routing decisions, keyed by a hash of (previous agent, tail of the
+# transcript), so an identical routing question never costs a second LLM call.
+_DECISION_CACHE_SIZE = 512
+_decision_cache = OrderedDict()
+_decision_lock = threading.Lock()
+
+def _decision_key(last_agent: str, user_input: str) -> str:
+    return hashlib.sha256((last_agent + "||" + user_input[-1024:]).encode("utf-8")).hexdigest()
+
 class _RouterChainAdapter:
-    def run(self, user_input: str) -> str:
-        if contains_crisis_keywords(user_input):
+    def run(self, user_input: str, last_agent: str = "", crisis=None) -> str:
+        """Blocking wrapper around arun() for synchronous callers."""
+        return run_async(self.arun(user_input, last_agent, crisis))
+
+    async def arun(self, user_input: str, last_agent: str = "", crisis=None) -> str:
+        """
+        Classifies the next turn without blocking the loop, so it can overlap with other LLM calls.
+        Callers that have already run the crisis-keyword check on this input pass its result as
+        `crisis`; with None the input is scanned here.
+        """
+        # Crisis is checked before the cache so it can never be masked by a cached label
+        if crisis is None:
+            crisis = contains_crisis_keywords(user_input)
+        if crisis:
             return "crisis"
+        key = _decision_key(last_agent, user_input)
+        with _decision_lock:
+            label = _decision_cache.get(key)
+            if label is not None:
+                _decision_cache.move_to_end(key)
+                return label
         try:
-            out = _chain.run({"input": user_input})
-            return _normalize_label(out)
+            out = await _chain.ainvoke({"input": user_input})
         except Exception as e:
             print(f"Router LLM failed: {e}. Falling back to mood agent.")
             return "mood"
+        label = _normalize_label(out.get("text"))
+        with _decision_lock:
+            _decision_cache[key] = label
+            if len(_decision_cache) > _DECISION_CACHE_SIZE:
+                _decision_cache.popitem(last=False)
+        return label
 
 router_chain = _RouterChainAdapter()
\ No newline at end of file
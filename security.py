@@ -18,6 +18,7 @@ def totp_provisioning_uri(secret: str, username: str, issuer_name: str = "Synerm
 def qr_png_data_uri(content: str) -> str:
     img = qrcode.make(content)
     buf = BytesIO()
-    img.save(buf, format="PNG")
+    # A QR code is two-colour and tiny; fast zlib settings lose almost nothing.
+    img.save(buf, format="PNG", optimize=False, compress_level=1)
     b64 = base64.b64encode(buf.getvalue()).decode()
     return f"data:image/png;base64,{b64}"